@@ -0,0 +1,223 @@
+from math import cos, sin, atan2, hypot, pi
+import numpy as np
+
+'''
+2d rigid body math (what WPILib calls Pose2d, Transform2d and Twist2d)
+Every method changes the object it is called on (or out) and returns it, so nothing is allocated in the loop
+'''
+
+
+def wrap_angle(theta):
+    return (theta + pi) % (2 * pi) - pi
+
+
+class Pose:
+    '''
+    Data type to represent: position (x, y) and rotation (theta)
+    '''
+    __slots__ = ('x', 'y', 'theta', 'x_vel', 'y_vel', 'theta_vel')
+
+    def __init__(self, x=0, y=0, theta=0):
+        self.x, self.y, self.theta = x, y, theta
+        self.x_vel, self.y_vel, self.theta_vel = 0, 0, 0
+
+    def __call__(self, x, y, theta):
+        self.x, self.y, self.theta = x, y, theta
+        return self
+
+    def __iter__(self):
+        return iter((self.x, self.y, self.theta))
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.x}, {self.y}, {self.theta})"
+
+    def set(self, other):
+        self.x, self.y, self.theta = other.x, other.y, other.theta
+        return self
+
+    def copy(self):
+        return type(self)(self.x, self.y, self.theta)
+
+    def compose(self, transform, out=None):
+        '''
+        Move by transform, which is relative to this pose's heading
+        '''
+        out = self if out is None else out
+        c, s = cos(self.theta), sin(self.theta)
+        tx, ty = transform.x, transform.y
+        out.x, out.y, out.theta = self.x + tx * c - ty * s, self.y + tx * s + ty * c, self.theta + transform.theta
+        return out
+
+    def inverse(self, out=None):
+        '''
+        The transform that undoes this one
+        '''
+        out = self if out is None else out
+        c, s = cos(self.theta), sin(self.theta)
+        x, y = self.x, self.y
+        out.x, out.y, out.theta = -x * c - y * s, x * s - y * c, -self.theta
+        return out
+
+    def relative_to(self, other, out=None):
+        '''
+        This pose as seen from other (the transform that moves other onto this pose)
+        '''
+        out = self if out is None else out
+        c, s = cos(other.theta), sin(other.theta)
+        dx, dy = self.x - other.x, self.y - other.y
+        out.x, out.y, out.theta = dx * c + dy * s, -dx * s + dy * c, wrap_angle(self.theta - other.theta)
+        return out
+
+    def exp(self, twist, out=None):
+        '''
+        Follow a constant curvature twist from this pose
+        '''
+        out = self if out is None else out
+        dx, dy, dtheta = twist.dx, twist.dy, twist.dtheta
+        if abs(dtheta) < 1e-9:
+            s, c = 1 - dtheta * dtheta / 6, 0.5 * dtheta
+        else:
+            s, c = sin(dtheta) / dtheta, (1 - cos(dtheta)) / dtheta
+        tx, ty = dx * s - dy * c, dx * c + dy * s
+        ct, st = cos(self.theta), sin(self.theta)
+        out.x, out.y, out.theta = self.x + tx * ct - ty * st, self.y + tx * st + ty * ct, self.theta + dtheta
+        return out
+
+    def log(self, other, out):
+        '''
+        The twist that moves this pose onto other, written to out
+        '''
+        c, s = cos(self.theta), sin(self.theta)
+        dx, dy = other.x - self.x, other.y - self.y
+        x, y, dtheta = dx * c + dy * s, -dx * s + dy * c, wrap_angle(other.theta - self.theta)
+        half = dtheta / 2
+        cos_minus_one = cos(dtheta) - 1
+        if abs(cos_minus_one) < 1e-9:
+            half_by_tan = 1 - dtheta * dtheta / 12
+        else:
+            half_by_tan = -(half * sin(dtheta)) / cos_minus_one
+        out.dx, out.dy, out.dtheta = x * half_by_tan + y * half, -x * half + y * half_by_tan, dtheta
+        return out
+
+    def distance(self, other):
+        return hypot(other.x - self.x, other.y - self.y)
+
+    def heading_to(self, other):
+        return atan2(other.y - self.y, other.x - self.x)
+
+
+class Transform(Pose):
+    '''
+    A change in position and rotation, relative to the heading of the pose it is applied to
+    '''
+    __slots__ = ()
+
+
+class Twist:
+    '''
+    Velocity (or a small move) along a constant curvature arc: forward dx, sideways dy, turn dtheta
+    '''
+    __slots__ = ('dx', 'dy', 'dtheta')
+
+    def __init__(self, dx=0, dy=0, dtheta=0):
+        self.dx, self.dy, self.dtheta = dx, dy, dtheta
+
+    def __call__(self, dx, dy, dtheta):
+        self.dx, self.dy, self.dtheta = dx, dy, dtheta
+        return self
+
+    def __iter__(self):
+        return iter((self.dx, self.dy, self.dtheta))
+
+    def __repr__(self):
+        return f"Twist({self.dx}, {self.dy}, {self.dtheta})"
+
+    def scale(self, factor):
+        self.dx *= factor
+        self.dy *= factor
+        self.dtheta *= factor
+        return self
+
+
+class PoseArray:
+    '''
+    Many poses stored as one array per field (ie a trajectory or a replayed log)
+    '''
+    __slots__ = ('x', 'y', 'theta')
+
+    def __init__(self, x, y=None, theta=None):
+        if y is None:  # allocate n zeroed poses
+            x, y, theta = np.zeros(x), np.zeros(x), np.zeros(x)
+        self.x, self.y, self.theta = np.asarray(x, dtype=float), np.asarray(y, dtype=float), np.asarray(theta, dtype=float)
+
+    def __len__(self):
+        return len(self.x)
+
+    def get(self, i, out):
+        return out(self.x[i], self.y[i], self.theta[i])
+
+    def put(self, i, pose):
+        self.x[i], self.y[i], self.theta[i] = pose.x, pose.y, pose.theta
+
+    def compose(self, transform):
+        '''
+        Move every pose by the same transform (in place)
+        '''
+        c, s = np.cos(self.theta), np.sin(self.theta)
+        self.x += transform.x * c - transform.y * s
+        self.y += transform.x * s + transform.y * c
+        self.theta += transform.theta
+        return self
+
+    def relative_to(self, pose):
+        '''
+        Every pose as seen from pose, written into the existing arrays (so views of them stay valid)
+        Not allocation free, the rotation needs a few temporary arrays
+        '''
+        c, s = cos(pose.theta), sin(pose.theta)
+        x, y, theta = self.x, self.y, self.theta
+        x -= pose.x
+        y -= pose.y
+        dx = x.copy()
+        x *= c
+        x += s * y
+        y *= c
+        y -= s * dx
+        theta -= pose.theta - pi  # wrap_angle(theta - pose.theta), in place
+        np.mod(theta, 2 * pi, out=theta)
+        theta -= pi
+        return self
+
+
+if __name__ == "__main__":  # benchmark against the old dict backed Pose
+    import sys, timeit, tracemalloc
+
+    class OldPose:
+        def __init__(self, x, y, theta):
+            self.x, self.y, self.theta = x, y, theta
+            self.x_vel, self.y_vel, self.theta_vel = 0, 0, 0
+
+        def __iter__(self):
+            return iter((self.x, self.y, self.theta))
+
+    def old_tick(pose, move=OldPose(0.01, 0.002, 0.001)):  # what callers had to do: build a new pose every tick
+        x, y, theta = pose
+        c, s = cos(theta), sin(theta)
+        return OldPose(x + move.x * c - move.y * s, y + move.x * s + move.y * c, theta + move.theta)
+
+    def new_tick(pose, move=Transform(0.01, 0.002, 0.001)):
+        return pose.compose(move)
+
+    n = 200000
+    for name, tick, pose in (("old", old_tick, OldPose(0, 0, 0)), ("new", new_tick, Pose())):
+        state = [pose]
+
+        def loop():
+            state[0] = tick(state[0])
+        elapsed = timeit.timeit(loop, number=n)
+        tracemalloc.start()
+        for _ in range(1000): loop()
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        instance = sys.getsizeof(pose) + (sys.getsizeof(pose.__dict__) if hasattr(pose, '__dict__') else 0)
+        print(f"{name}: {elapsed / n * 1e9:.0f} ns/tick, {instance} bytes/pose, {peak} bytes peak over 1000 ticks")
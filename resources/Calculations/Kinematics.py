@@ -1,29 +1,40 @@
-import time
+from math import cos, sin, sqrt
+import numpy as np
 from resources.Calculations.math_utils import *
+from resources.Calculations.Geometry import Twist, wrap_angle
 from resources.Interfaces.Motors import MotorController
+from resources.Structure.Clock import now
 
 
 class PID:
     """
-    Simple PID control.
+    PID control with integral anti-windup, a filtered derivative, output limits and continuous (angle) inputs.
     """
 
     def __init__(self, p=0, i=0, d=0, **kwargs):
 
-        self._get_time = kwargs.pop('get_time', None) or time.time
+        self._get_time = kwargs.pop('get_time', None) or now
 
         # initialze gains
         self.Kp = p
         self.Ki = i
         self.Kd = d
 
+        # output = clamp(Kp * error + Ki * integral + derivative)
+        self.min_output, self.max_output = kwargs.pop('output_limits', (-float('inf'), float('inf')))
+        self.integral_limit = kwargs.pop('integral_limit', float('inf'))  # largest Ki * integral can get
+        self.derivative_filter = kwargs.pop('derivative_filter', 0)  # time constant (s) of the derivative low pass
+        self.continuous = kwargs.pop('continuous', None)  # (min, max) of an input that wraps, ie (0, 2 * pi)
+
         # The value the controller is trying to get the system to achieve.
         self._target = 0
 
         # initialize delta t variables
         self._prev_tm = self._get_time()
 
-        self._prev_feedback = 0
+        self._prev_feedback = None
+        self._integral = 0
+        self._derivative = 0
 
         self._error = None
 
@@ -39,6 +50,16 @@ class PID:
     def target(self, v):
         self._target = float(v)
 
+    def reset(self):
+        self._integral = self._derivative = 0
+        self._prev_feedback = None
+        self._prev_tm = self._get_time()
+
+    def _wrap(self, difference):
+        low, high = self.continuous
+        span = high - low
+        return (difference + span / 2) % span - span / 2
+
     def __call__(self, feedback, curr_tm=None):
         """ Performs a PID computation and returns a control value.
 
@@ -48,31 +69,112 @@ class PID:
         """
 
         # Calculate error.
-        error = self._error = self._target - feedback
+        error = self._target - feedback
+        if self.continuous is not None:  # go the short way around
+            error = self._wrap(error)
+        self._error = error
 
         # Calculate time differential.
         if curr_tm is None:
             curr_tm = self._get_time()
         dt = curr_tm - self._prev_tm
 
-        # Initialize output variable.
-        alpha = 0
+        # Accumulate the integral, limited so it can't wind up past what the output can use.
+        integral = self._integral
+        if self.Ki:
+            integral += error * dt
+            limit = self.integral_limit / abs(self.Ki)
+            integral = -limit if integral < -limit else limit if integral > limit else integral
+
+        # Differentiate the measurement (not the error, so target changes don't kick) through a low pass filter.
+        if dt > 0 and self._prev_feedback is not None:
+            change = feedback - self._prev_feedback
+            if self.continuous is not None:
+                change = self._wrap(change)
+            alpha = dt / (self.derivative_filter + dt)
+            self._derivative += alpha * (-change / dt - self._derivative)
+
+        output = self.Kp * error + self.Ki * integral + self.Kd * self._derivative
+
+        # Clamp, and only keep the new integral if it isn't pushing further into the limit.
+        if output > self.max_output:
+            output = self.max_output
+            if error < 0: self._integral = integral
+        elif output < self.min_output:
+            output = self.min_output
+            if error > 0: self._integral = integral
+        else:
+            self._integral = integral
 
-        # Add proportional component.
-        alpha -= self.Kp * error
+        # Maintain memory for next loop.
+        self._prev_tm = curr_tm
+        self._prev_feedback = feedback
 
-        # Add integral component.
-        alpha -= self.Ki * (error * dt)
+        return output
 
-        # Add differential component (avoiding divide-by-zero).
-        if dt > 0:
-            alpha -= self.Kd * ((feedback - self._prev_feedback) / float(dt))
 
-        # Maintain memory for next loop.
+class PIDBank:
+    """
+    Many independent PID controllers (ie one per axis of a mechanism) stepped together in one numpy call.
+    Gains and limits can be scalars or one value per controller.
+    """
+
+    def __init__(self, n, p=0, i=0, d=0, **kwargs):
+        self._get_time = kwargs.pop('get_time', None) or now
+        self.Kp, self.Ki, self.Kd = (np.full(n, gain, dtype=float) for gain in (p, i, d))
+        min_output, max_output = kwargs.pop('output_limits', (-np.inf, np.inf))
+        self.min_output, self.max_output = np.full(n, min_output, dtype=float), np.full(n, max_output, dtype=float)
+        self.integral_limit = np.full(n, kwargs.pop('integral_limit', np.inf), dtype=float)
+        self.derivative_filter = np.full(n, kwargs.pop('derivative_filter', 0), dtype=float)
+        self.continuous = kwargs.pop('continuous', None)
+
+        self.target = np.zeros(n)
+        self.error = np.zeros(n)
+        self._integral = np.zeros(n)
+        self._derivative = np.zeros(n)
+        self._prev_feedback = None
+        self._prev_tm = self._get_time()
+
+    def reset(self):
+        self._integral[:] = 0
+        self._derivative[:] = 0
+        self._prev_feedback = None
+        self._prev_tm = self._get_time()
+
+    def _wrap(self, difference):
+        low, high = self.continuous
+        span = high - low
+        return (difference + span / 2) % span - span / 2
+
+    def __call__(self, feedback, curr_tm=None):
+        feedback = np.asarray(feedback, dtype=float)
+        error = self.target - feedback
+        if self.continuous is not None:
+            error = self._wrap(error)
+        self.error = error
+
+        if curr_tm is None:
+            curr_tm = self._get_time()
+        dt = curr_tm - self._prev_tm
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            limit = np.where(self.Ki != 0, self.integral_limit / np.abs(self.Ki), 0)
+        integral = np.clip(self._integral + error * dt, -limit, limit)
+
+        if dt > 0 and self._prev_feedback is not None:
+            change = feedback - self._prev_feedback
+            if self.continuous is not None:
+                change = self._wrap(change)
+            self._derivative += dt / (self.derivative_filter + dt) * (-change / dt - self._derivative)
+
+        output = self.Kp * error + self.Ki * integral + self.Kd * self._derivative
+        clamped = np.clip(output, self.min_output, self.max_output)
+        winding = ((output > self.max_output) & (error > 0)) | ((output < self.min_output) & (error < 0))
+        self._integral = np.where(winding, self._integral, integral)
+
         self._prev_tm = curr_tm
         self._prev_feedback = feedback
-
-        return alpha
+        return clamped
 
 
 class Feedforward:
@@ -86,7 +188,9 @@ class Feedforward:
         return self.estimate(vel, acc)
 
     def estimate(self, vel, acc=0):
-        return self.ks + vel * self.kv + acc * self.ka  # i have no evidence this works
+        direction = vel if vel else acc  # static friction opposes the way it is (or is about to start) moving
+        friction = apply_sign(self.ks, direction) if direction else 0
+        return friction + vel * self.kv + acc * self.ka
 
 
 class DriveController:
@@ -95,7 +199,7 @@ class DriveController:
     '''
     def __init__(self, left_control: MotorController, right_control: MotorController):
         self.left = left_control
-        self
+        self.right = right_control
 
     def arcade_drive(self, speed, rotation, square_inputs=True):
         if square_inputs:
@@ -127,4 +231,258 @@ class DriveController:
 
 
 class Ramsete:  # https://github.com/wpilibsuite/allwpilib/blob/master/wpilibNewCommands/src/main/java/edu/wpi/first/wpilibj2/command/RamseteCommand.java
-    pass
\ No newline at end of file
+    '''
+    Nonlinear controller that follows a trajectory
+    b (> 0) is like a proportional gain, zeta (0 to 1) is like damping
+    '''
+    def __init__(self, track_width, b=2.0, zeta=0.7):
+        self.track_width = track_width
+        self.b = b
+        self.zeta = zeta
+        self.velocity = self.angular_velocity = 0  # outputs of the last calculate
+        self.left_speed = self.right_speed = 0
+
+    def calculate(self, pose, state):
+        '''
+        Linear and angular velocity to get from pose to the trajectory state (anything with x, y, theta, velocity, curvature)
+        '''
+        c, s = cos(pose.theta), sin(pose.theta)
+        dx, dy = state.x - pose.x, state.y - pose.y
+        error_x, error_y = c * dx + s * dy, -s * dx + c * dy  # error in the robot's frame
+        error_theta = wrap_angle(state.theta - pose.theta)
+
+        velocity = state.velocity
+        angular_velocity = velocity * state.curvature
+        k = 2 * self.zeta * sqrt(angular_velocity * angular_velocity + self.b * velocity * velocity)
+        sinc = sin(error_theta) / error_theta if abs(error_theta) > 1e-9 else 1 - error_theta * error_theta / 6
+        self.velocity = velocity * cos(error_theta) + k * error_x
+        self.angular_velocity = angular_velocity + k * error_theta + self.b * velocity * sinc * error_y
+        self.left_speed = self.velocity - self.angular_velocity * self.track_width / 2
+        self.right_speed = self.velocity + self.angular_velocity * self.track_width / 2
+        return self.velocity, self.angular_velocity
+
+    def drive(self, drive_controller: DriveController, pose, state):
+        self.calculate(pose, state)
+        drive_controller.tank_drive(self.left_speed, self.right_speed)
+
+    @staticmethod
+    def calculate_batch(x, y, theta, reference_x, reference_y, reference_theta, reference_velocity, reference_curvature, b, zeta):
+        '''
+        The control law over arrays (anything that broadcasts, ie one reference against many b and zeta values)
+        '''
+        c, s = np.cos(theta), np.sin(theta)
+        dx, dy = reference_x - x, reference_y - y
+        error_x, error_y = c * dx + s * dy, -s * dx + c * dy
+        error_theta = wrap_angle(reference_theta - theta)
+        angular_velocity = reference_velocity * reference_curvature
+        k = 2 * zeta * np.sqrt(angular_velocity ** 2 + b * reference_velocity ** 2)
+        velocity = reference_velocity * np.cos(error_theta) + k * error_x
+        angular_velocity = angular_velocity + k * error_theta + b * reference_velocity * np.sinc(error_theta / np.pi) * error_y
+        return velocity, angular_velocity
+
+    @staticmethod
+    def sweep(trajectory, b_values, zeta_values, start=(0, 0, 0), period=0.02):
+        '''
+        Simulate following trajectory from start with every combination of b and zeta at once
+        Returns the rms and final position error for each combination as (len(b_values), len(zeta_values)) arrays
+        '''
+        b, zeta = np.meshgrid(np.asarray(b_values, dtype=float), np.asarray(zeta_values, dtype=float), indexing='ij')
+        b, zeta = b.ravel(), zeta.ravel()
+        x, y, theta = (np.full(len(b), float(value)) for value in start)
+
+        data = trajectory.data
+        times = np.arange(0, trajectory.total_time + period, period)
+        reference = [np.interp(times, data[trajectory.TIME], data[row])
+                     for row in (trajectory.X, trajectory.Y, trajectory.THETA, trajectory.VELOCITY, trajectory.CURVATURE)]
+        reference[2] = np.interp(times, data[trajectory.TIME], np.unwrap(data[trajectory.THETA]))
+
+        squared_error = np.zeros(len(b))
+        for reference_x, reference_y, reference_theta, reference_velocity, reference_curvature in zip(*reference):
+            velocity, angular_velocity = Ramsete.calculate_batch(x, y, theta, reference_x, reference_y, reference_theta,
+                                                                 reference_velocity, reference_curvature, b, zeta)
+            # drive along the arc for one period
+            turn = angular_velocity * period
+            move = velocity * period
+            straight = np.abs(turn) < 1e-9
+            radius = move / np.where(straight, 1, turn)
+            new_theta = theta + turn
+            x = x + np.where(straight, move * np.cos(theta), radius * (np.sin(new_theta) - np.sin(theta)))
+            y = y + np.where(straight, move * np.sin(theta), radius * (np.cos(theta) - np.cos(new_theta)))
+            theta = new_theta
+            squared_error += (reference_x - x) ** 2 + (reference_y - y) ** 2
+
+        final_error = np.hypot(reference[0][-1] - x, reference[1][-1] - y)
+        shape = len(b_values), len(zeta_values)
+        return np.sqrt(squared_error / len(times)).reshape(shape), final_error.reshape(shape)
+
+
+class HolonomicKinematics:
+    '''
+    Kinematics from a fixed matrix: wheel velocities = inverse @ (vx, vy, omega), chassis speeds = forward @ wheel velocities
+    Chassis speeds are a Twist (dx forward, dy left, dtheta counter clockwise) relative to the robot
+    '''
+    def __init__(self, inverse):
+        self.inverse = np.asarray(inverse, dtype=float)
+        self.forward = np.linalg.pinv(self.inverse)  # least squares, the wheels can disagree when they slip
+        self._speeds = np.zeros(3)
+
+    def _chassis_vector(self, speeds, center=None):
+        vector = self._speeds
+        vector[0], vector[1], vector[2] = speeds.dx, speeds.dy, speeds.dtheta
+        if center is not None:  # rotate around center instead of the middle of the robot
+            vector[0] += speeds.dtheta * center[1]
+            vector[1] -= speeds.dtheta * center[0]
+        return vector
+
+    def wheel_velocities(self, speeds, center=None, out=None):
+        return np.matmul(self.inverse, self._chassis_vector(speeds, center), out=out)
+
+    def chassis_speeds(self, wheel_velocities, out=None):
+        vx, vy, omega = (self.forward @ np.asarray(wheel_velocities, dtype=float)).tolist()
+        return Twist(vx, vy, omega) if out is None else out(vx, vy, omega)
+
+    def wheel_velocities_batch(self, vx, vy, omega):
+        '''
+        Wheel velocities for arrays of chassis speeds, (len(vx), rows of inverse)
+        '''
+        return np.column_stack(np.broadcast_arrays(vx, vy, omega)).astype(float) @ self.inverse.T
+
+    def chassis_speeds_batch(self, wheel_velocities):
+        '''
+        (vx, vy, omega) arrays from an array of wheel velocities per sample
+        '''
+        return tuple((np.asarray(wheel_velocities, dtype=float) @ self.forward.T).T)
+
+    @staticmethod
+    def desaturate(speeds, max_speed):
+        '''
+        Scale every wheel speed down together (in place) so none are over max_speed, keeping the direction of motion
+        '''
+        fastest = np.abs(speeds).max()
+        if fastest > max_speed:
+            speeds *= max_speed / fastest
+        return speeds
+
+
+class MecanumKinematics(HolonomicKinematics):
+    '''
+    Mecanum wheels at (x, y) from the center of the robot (x forward, y left), front left, front right, back left, back right
+    Roller signs are which way each wheel's rollers push it sideways (the usual X pattern by default)
+    '''
+    def __init__(self, wheel_positions, roller_signs=(-1, 1, 1, -1)):
+        self.wheel_positions = np.asarray(wheel_positions, dtype=float)
+        inverse = [[1, sign, sign * x - y] for (x, y), sign in zip(self.wheel_positions, roller_signs)]
+        super().__init__(inverse)
+
+
+class SwerveKinematics(HolonomicKinematics):
+    '''
+    Swerve modules at (x, y) from the center of the robot (x forward, y left)
+    Module states are (speeds, angles) arrays, one entry per module
+    '''
+    def __init__(self, module_positions):
+        self.module_positions = np.asarray(module_positions, dtype=float)
+        inverse = []
+        for x, y in self.module_positions:  # each module moves at the chassis velocity plus omega cross its position
+            inverse.append([1, 0, -y])
+            inverse.append([0, 1, x])
+        super().__init__(inverse)
+        self.count = len(self.module_positions)
+
+    def module_states(self, speeds, center=None, max_speed=None, current_angles=None):
+        '''
+        Speed and angle of every module for chassis speeds (a Twist), desaturated to max_speed
+        and optimized against current_angles so no module turns more than 90 degrees
+        '''
+        velocities = self.wheel_velocities(speeds, center).reshape(self.count, 2)
+        module_speeds = np.hypot(velocities[:, 0], velocities[:, 1])
+        angles = np.arctan2(velocities[:, 1], velocities[:, 0])
+        if max_speed is not None:
+            self.desaturate(module_speeds, max_speed)
+        if current_angles is not None:
+            self.optimize(module_speeds, angles, current_angles)
+        return module_speeds, angles
+
+    @staticmethod
+    def optimize(speeds, angles, current_angles):
+        '''
+        Flip (in place) any module that would turn more than 90 degrees to point the other way and drive backwards
+        Works on arrays of any shape (ie samples by modules)
+        '''
+        flip = np.abs(wrap_angle(angles - current_angles)) > np.pi / 2
+        speeds[flip] *= -1
+        angles[flip] = wrap_angle(angles[flip] + np.pi)
+        return speeds, angles
+
+    def chassis_speeds_from_states(self, speeds, angles, out=None):
+        '''
+        Chassis speeds (a Twist) from measured module speeds and angles, also works for distances travelled
+        '''
+        velocities = np.empty(2 * self.count)
+        velocities[0::2] = speeds * np.cos(angles)
+        velocities[1::2] = speeds * np.sin(angles)
+        return self.chassis_speeds(velocities, out)
+
+    def module_states_batch(self, vx, vy, omega, max_speed=None):
+        '''
+        (speeds, angles) arrays shaped (samples, modules) for arrays of chassis speeds
+        '''
+        velocities = self.wheel_velocities_batch(vx, vy, omega).reshape(-1, self.count, 2)
+        speeds = np.hypot(velocities[..., 0], velocities[..., 1])
+        angles = np.arctan2(velocities[..., 1], velocities[..., 0])
+        if max_speed is not None:
+            fastest = speeds.max(axis=1, keepdims=True)
+            speeds *= np.minimum(1, max_speed / np.maximum(fastest, 1e-12))
+        return speeds, angles
+
+    def chassis_speeds_batch_from_states(self, speeds, angles):
+        '''
+        (vx, vy, omega) arrays from (samples, modules) arrays of module speeds and angles
+        '''
+        velocities = np.empty(speeds.shape[:-1] + (2 * self.count,))
+        velocities[..., 0::2] = speeds * np.cos(angles)
+        velocities[..., 1::2] = speeds * np.sin(angles)
+        return self.chassis_speeds_batch(velocities)
+
+
+if __name__ == "__main__":  # benchmark the controllers on a simulated first order system
+    import timeit
+
+    class OldPID:  # the PID this file used to have
+        def __init__(self, p=0, i=0, d=0):
+            self.Kp, self.Ki, self.Kd = p, i, d
+            self._target, self._prev_tm, self._prev_feedback = 0, 0, 0
+
+        def __call__(self, feedback, curr_tm):
+            error = self._target - feedback
+            dt = curr_tm - self._prev_tm
+            alpha = 0
+            alpha -= self.Kp * error
+            alpha -= self.Ki * (error * dt)
+            if dt > 0:
+                alpha -= self.Kd * ((feedback - self._prev_feedback) / float(dt))
+            self._prev_tm = curr_tm
+            self._prev_feedback = feedback
+            return alpha
+
+    period, steps, axes = 0.01, 500, 64
+
+    def closed_loop(controller, sign=1):
+        controller._target, value = 1.0, 0.0
+        for step in range(steps):
+            output = sign * controller(value, step * period)
+            value += (output - value) * period * 5  # first order plant
+        return value
+
+    def bank_loop(bank):
+        bank.target[:] = 1.0
+        value = np.zeros(axes)
+        for step in range(steps):
+            value += (bank(value, step * period) - value) * period * 5
+        return value
+
+    old = timeit.timeit(lambda: closed_loop(OldPID(2, 1, 0.01), -1), number=20) / (20 * steps)
+    new = timeit.timeit(lambda: closed_loop(PID(2, 1, 0.01, output_limits=(-10, 10), get_time=lambda: 0)), number=20) / (20 * steps)
+    bank = timeit.timeit(lambda: bank_loop(PIDBank(axes, 2, 1, 0.01, output_limits=(-10, 10), get_time=lambda: 0)), number=20) / (20 * steps)
+    print(f"old PID: {old * 1e6:.2f} us/call, new PID: {new * 1e6:.2f} us/call")
+    print(f"PIDBank of {axes}: {bank * 1e6:.2f} us/call ({bank / axes * 1e6:.2f} us per controller vs {new * 1e6:.2f} us)")
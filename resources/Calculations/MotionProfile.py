@@ -0,0 +1,203 @@
+from bisect import bisect_right
+from math import sqrt
+import numpy as np
+
+'''
+Motion profiles (like WPILib's TrapezoidProfile), a smooth path for position, velocity and acceleration to a goal
+A profile is a handful of constant jerk segments found once in calculate, so sampling any time is a few multiplies
+Feed the sampled velocity and acceleration to a Feedforward and the position to a PID
+'''
+
+
+class MotionProfile:
+    '''
+    Base class for profiles, subclasses say how to change velocity (_transition) and how fast to cruise (_peak)
+    Every segment starts at a time with a position, velocity, acceleration and a constant jerk
+    '''
+    def __init__(self, max_velocity, max_acceleration):
+        self.max_velocity = max_velocity
+        self.max_acceleration = max_acceleration
+        self.calculate(0, 0, 0)
+
+    def calculate(self, position, velocity, goal, goal_velocity=0):
+        '''
+        Plan from the current position and velocity to the goal, arriving at goal_velocity (time restarts at 0)
+        '''
+        self._times, self._positions, self._velocities, self._accelerations, self._jerks = [], [], [], [], []
+        self._arrays = None
+        self._time, self._position, self._velocity = 0, float(position), float(velocity)
+        self._plan(float(goal), float(goal_velocity))
+        self._add(0, 0)  # hold the final velocity after the end
+        return self
+
+    def retarget(self, time, goal, goal_velocity=0):
+        '''
+        Plan to a new goal from wherever this profile is at time, cheap enough to do every loop tick
+        '''
+        position, velocity, _ = self.sample(time)
+        return self.calculate(position, velocity, goal, goal_velocity)
+
+    def _plan(self, goal, goal_velocity):
+        max_velocity = self.max_velocity
+        direction = 1 if goal >= self._position else -1  # plan as if moving forward, flipping the signs back in _add
+        self._direction = direction
+        distance = (goal - self._position) * direction
+        start, end = self._velocity * direction, min(max(goal_velocity * direction, -max_velocity), max_velocity)
+
+        if self._distance(start, end) > distance:
+            if start > end:  # too fast to stop in time: stop past the goal and come back
+                self._transition(start, 0)
+                self._plan(goal, goal_velocity)
+                return
+            low, high = start, end  # can't speed up enough: reach the fastest end velocity possible
+            for _ in range(40):
+                middle = (low + high) / 2
+                low, high = (middle, high) if self._distance(start, middle) <= distance else (low, middle)
+            self._transition(start, low)
+            return
+
+        peak = self._peak(distance, start, end) if max(start, end) < max_velocity else max_velocity
+        self._transition(start, peak)
+        cruise = distance - self._distance(start, peak) - self._distance(peak, end)
+        if peak > 0 and cruise > 0:
+            self._add(cruise / peak, 0)
+        self._transition(peak, end)
+
+    def _peak(self, distance, start, end):
+        '''
+        Fastest velocity (up to max_velocity) that still leaves room to get from start to end within distance
+        '''
+        low, high = max(start, end), self.max_velocity
+        if self._distance(start, high) + self._distance(high, end) <= distance:
+            return high
+        for _ in range(40):
+            middle = (low + high) / 2
+            low, high = (middle, high) if self._distance(start, middle) + self._distance(middle, end) <= distance else (low, middle)
+        return low
+
+    def _distance(self, start, end):
+        '''
+        How far it goes changing velocity from start to end, all the transitions here are symmetric so this is average * time
+        '''
+        return (start + end) / 2 * self._transition_time(abs(end - start))
+
+    def _transition_time(self, change):  # override this
+        pass
+
+    def _transition(self, start, end):  # override this
+        pass
+
+    def _add(self, duration, acceleration, jerk=0):
+        '''
+        Append a segment (acceleration and jerk are in the planning direction) and move the end state past it
+        '''
+        acceleration, jerk = acceleration * self._direction if duration else 0, jerk * self._direction
+        self._times.append(self._time)
+        self._positions.append(self._position)
+        self._velocities.append(self._velocity)
+        self._accelerations.append(acceleration)
+        self._jerks.append(jerk)
+        t = duration
+        self._position += self._velocity * t + acceleration * t * t / 2 + jerk * t * t * t / 6
+        self._velocity += acceleration * t + jerk * t * t / 2
+        self._time += t
+
+    @property
+    def total_time(self):
+        return self._times[-1]
+
+    def finished(self, time):
+        return time >= self._times[-1]
+
+    def sample(self, time):
+        '''
+        (position, velocity, acceleration) at time seconds after calculate
+        '''
+        i = bisect_right(self._times, time) - 1
+        if i < 0:
+            return self._positions[0], self._velocities[0], 0
+        t = time - self._times[i]
+        v, a, j = self._velocities[i], self._accelerations[i], self._jerks[i]
+        return (self._positions[i] + v * t + a * t * t / 2 + j * t * t * t / 6,
+                v + a * t + j * t * t / 2,
+                a + j * t)
+
+    def sample_array(self, times):
+        '''
+        sample over an array of times at once, returns position, velocity and acceleration arrays
+        '''
+        if self._arrays is None:
+            self._arrays = tuple(np.array(values, dtype=float) for values in
+                                 (self._times, self._positions, self._velocities, self._accelerations, self._jerks))
+        starts, positions, velocities, accelerations, jerks = self._arrays
+        times = np.asarray(times, dtype=float)
+        i = np.maximum(np.searchsorted(starts, times, side='right') - 1, 0)
+        t = np.maximum(times - starts[i], 0)
+        v, a, j = velocities[i], accelerations[i], jerks[i]
+        return (positions[i] + t * (v + t * (a / 2 + t * j / 6)),
+                v + t * (a + t * j / 2),
+                np.where(times < 0, 0, a + j * t))
+
+
+class TrapezoidProfile(MotionProfile):
+    '''
+    Constant acceleration up to max_velocity, cruise, then constant deceleration
+    '''
+    def _transition_time(self, change):
+        return change / self.max_acceleration
+
+    def _transition(self, start, end):
+        if end != start:
+            self._add(abs(end - start) / self.max_acceleration, self.max_acceleration if end > start else -self.max_acceleration)
+        self._velocity = end * self._direction  # no rounding error carried into the next segment
+
+    def _peak(self, distance, start, end):
+        return min(self.max_velocity, sqrt(self.max_acceleration * distance + (start * start + end * end) / 2))
+
+
+class SCurveProfile(MotionProfile):
+    '''
+    Jerk limited profile, the acceleration ramps instead of stepping so the mechanism isn't jolted
+    Retargeting starts from the sampled position and velocity with zero acceleration
+    '''
+    def __init__(self, max_velocity, max_acceleration, max_jerk):
+        self.max_jerk = max_jerk
+        super().__init__(max_velocity, max_acceleration)
+
+    def _transition_time(self, change):
+        acceleration, jerk = self.max_acceleration, self.max_jerk
+        if change >= acceleration * acceleration / jerk:  # reaches max acceleration
+            return change / acceleration + acceleration / jerk
+        return 2 * sqrt(change / jerk)
+
+    def _transition(self, start, end):
+        change = abs(end - start)
+        if change:
+            sign = 1 if end > start else -1
+            acceleration, jerk = self.max_acceleration, self.max_jerk
+            if change >= acceleration * acceleration / jerk:
+                ramp, hold = acceleration / jerk, change / acceleration - acceleration / jerk
+            else:
+                ramp, hold = sqrt(change / jerk), 0
+            peak = sign * jerk * ramp
+            self._add(ramp, 0, sign * jerk)
+            if hold > 0:
+                self._add(hold, peak)
+            self._add(ramp, peak, -sign * jerk)
+        self._velocity = end * self._direction
+
+
+if __name__ == "__main__":  # check the limits and time sampling and retargeting
+    import timeit
+
+    for profile in (TrapezoidProfile(3, 2), SCurveProfile(3, 2, 10)):
+        profile.calculate(0, 0, 5)
+        times = np.linspace(0, profile.total_time, 2001)
+        position, velocity, acceleration = profile.sample_array(times)
+        print(f"{type(profile).__name__}: {profile.total_time:.3f}s, ends at {position[-1]:.6f} "
+              f"moving {velocity[-1]:.6f}, peak v {velocity.max():.3f} a {np.abs(acceleration).max():.3f}")
+        sample = timeit.timeit(lambda: profile.sample(1.234), number=100000) / 100000
+        retarget = timeit.timeit(lambda: profile.retarget(0.5, 4), number=2000) / 2000
+        batch = timeit.timeit(lambda: profile.sample_array(times), number=200) / 200
+        print(f"  sample: {sample * 1e6:.2f} us, retarget: {retarget * 1e6:.1f} us, "
+              f"sample_array of {len(times)}: {batch * 1e6:.0f} us")
@@ -1,48 +1,167 @@
 from math import cos, sin, pi
-from math_utils import *
-import time
+from resources.Calculations.math_utils import *
+from resources.Calculations.Geometry import Pose, Twist, wrap_angle
+from resources.Interfaces.Gyro import Gyro
+from resources.Structure.Clock import now
+import numpy as np
 
 
-class Pose:
+def _integrate(x, y, theta, delta_move, delta_turn):
     '''
-    Data type to represent: position (x, y) and rotation (theta)
+    Vectorized dead reckoning from (x, y, theta) through arrays of moves and turns
+    Each step is the arc from the previous heading to the new one, or a line if it didn't turn
+    Returns x, y, theta (not wrapped) after each step
     '''
-    def __init__(self, x, y, theta):
-        self.x, self.y, self.theta = x, y, theta
-        self.x_vel, self.y_vel, self.theta_vel = 0, 0, 0
+    thetas = theta + np.cumsum(delta_turn)
+    previous_theta = thetas - delta_turn
+    straight = np.abs(delta_turn) < 1e-12
+    radius = delta_move / np.where(straight, 1, delta_turn)
+    delta_x = np.where(straight, delta_move * np.cos(previous_theta), radius * (np.sin(thetas) - np.sin(previous_theta)))
+    delta_y = np.where(straight, delta_move * np.sin(previous_theta), radius * (np.cos(previous_theta) - np.cos(thetas)))
+    return x + np.cumsum(delta_x), y + np.cumsum(delta_y), thetas
 
-    def __call__(self, x, y, theta):
-        self.x, self.y, self.theta = x, y, theta
 
-    def __iter__(self):
-        return iter((self.x, self.y, self.theta))
+def _heading_turns(headings, last_heading, wheel_turns):
+    '''
+    Turns between consecutive headings (the shortest way around), the first one from last_heading like update does
+    Without a last heading the first turn comes from the wheels
+    '''
+    headings = np.asarray(headings, dtype=float)
+    if not len(headings):
+        return wheel_turns
+    turns = wrap_angle(np.diff(headings, prepend=headings[0] if last_heading is None else last_heading))
+    if last_heading is None:
+        turns[0] = wheel_turns[0]
+    return turns
+
+
+class PoseHistory:
+    '''
+    Fixed size ring buffer of timestamped poses and the move/turn that led to each one
+    Lets a late measurement be compared against where the robot was when it was taken
+    '''
+    TIME, X, Y, THETA, MOVE, TURN = range(6)
+
+    def __init__(self, capacity=512):
+        self.capacity = capacity
+        self._data = np.zeros((6, capacity))
+        self._start = 0  # index of the oldest sample
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def clear(self):
+        self._start = self._size = 0
+
+    def add(self, time, x, y, theta, move, turn):
+        i = self._start + self._size
+        if self._size == self.capacity:  # overwrite the oldest
+            self._start = (self._start + 1) % self.capacity
+        else:
+            self._size += 1
+        self._data[:, i % self.capacity] = time, x, y, theta, move, turn
+
+    def extend(self, times, x, y, theta, move, turn):
+        count = len(times)
+        if count > self.capacity:  # only the newest fit
+            times, x, y, theta, move, turn = (column[-self.capacity:] for column in (times, x, y, theta, move, turn))
+            count = self.capacity
+        indices = (self._start + self._size + np.arange(count)) % self.capacity
+        self._data[:, indices] = times, x, y, theta, move, turn
+        overflow = max(0, self._size + count - self.capacity)
+        self._start = (self._start + overflow) % self.capacity
+        self._size = min(self.capacity, self._size + count)
+
+    def _indices(self, first=0):
+        return (self._start + np.arange(first, self._size)) % self.capacity
+
+    def find(self, time):
+        '''
+        Number of samples taken at or before time (binary search over both halves of the ring)
+        '''
+        times = self._data[self.TIME]
+        end = self._start + self._size
+        if end <= self.capacity:
+            return int(np.searchsorted(times[self._start:end], time, side='right'))
+        older = times[self._start:]
+        if time < older[-1]:
+            return int(np.searchsorted(older, time, side='right'))
+        return len(older) + int(np.searchsorted(times[:end - self.capacity], time, side='right'))
+
+    def get(self, i):
+        '''
+        The ith oldest sample as (time, x, y, theta, move, turn)
+        '''
+        return tuple(self._data[:, (self._start + i) % self.capacity])
+
+    def sample(self, time):
+        '''
+        Interpolated (x, y, theta) at time, clamped to the oldest and newest samples
+        '''
+        if not self._size:
+            return None
+        i = self.find(time)
+        if i == 0:
+            return self.get(0)[1:4]
+        if i == self._size:
+            return self.get(i - 1)[1:4]
+        t0, x0, y0, theta0, _, _ = self.get(i - 1)
+        t1, x1, y1, theta1, _, _ = self.get(i)
+        fraction = (time - t0) / (t1 - t0) if t1 > t0 else 0
+        delta_theta = (theta1 - theta0 + pi) % (2 * pi) - pi
+        return x0 + (x1 - x0) * fraction, y0 + (y1 - y0) * fraction, (theta0 + delta_theta * fraction) % (2 * pi)
+
+    def columns(self, first=0):
+        '''
+        Copies of every column from the ith oldest sample onwards
+        '''
+        return self._data[:, self._indices(first)]
+
+    def rewrite(self, first, x, y, theta):
+        indices = self._indices(first)
+        self._data[self.X, indices] = x
+        self._data[self.Y, indices] = y
+        self._data[self.THETA, indices] = theta
 
 
 class Odometry:  # https://github.com/merose/diff_drive/blob/master/src/diff_drive/odometry.py
     '''
     Differential Odomentry: tracks a west-coast robot
     '''
-    def __init__(self, track_width, pose=(0, 0, 0)):
+    def __init__(self, track_width, pose=(0, 0, 0), history_size=512, gyro: Gyro = None):
         self.track_width = track_width
         self.pose = Pose(*pose)
-        self.previous_time = time.time()
+        self.previous_time = now()
+        self.history = PoseHistory(history_size)  # ~10 seconds at 50hz
+        self.gyro = gyro  # if given its heading is used for turning instead of the wheels (they slip)
+        self._last_heading = None  # the heading of the last update, turns are measured from it (not from the pose)
 
     def update(self, heading, left_move, right_move):  # todo: check if this works
+        '''
+        heading can be None to use the gyro (if there is one) or the difference between the wheels
+        '''
         # leftTravel = self.leftEncoder.getDelta() / self.ticksPerMeter  # idk what ticks per meter is
         # rightTravel = self.rightEncoder.getDelta() / self.ticksPerMeter
 
         # find how long since last update
-        new_time = time.time()
+        new_time = now()
         delta_time = new_time - self.previous_time
         self.previous_time = new_time
 
         # find how far it went and turning
+        if heading is None and self.gyro is not None:
+            heading = self.gyro.heading
         delta_move = average(left_move, right_move)
-        delta_turn = (right_move - left_move) / self.track_width
+        if heading is None or self._last_heading is None:
+            delta_turn = (right_move - left_move) / self.track_width
+        else:
+            delta_turn = wrap_angle(heading - self._last_heading)
+        self._last_heading = heading
 
-        if right_move == left_move:  # if it went straight
-            delta_x = left_move * cos(self.pose.theta)
-            delta_y = left_move * sin(self.pose.theta)
+        if abs(delta_turn) < 1e-12:  # if it went straight
+            delta_x = delta_move * cos(self.pose.theta)
+            delta_y = delta_move * sin(self.pose.theta)
         else:
             radius = delta_move / delta_turn
 
@@ -64,15 +183,178 @@ class Odometry:  # https://github.com/merose/diff_drive/blob/master/src/diff_dri
         self.pose.x_vel = delta_move / delta_time if delta_time > 0 else 0
         self.pose.y_vel = 0
         self.pose.theta_vel = delta_turn / delta_time if delta_time > 0 else 0
+        self.history.add(new_time, self.pose.x, self.pose.y, self.pose.theta, delta_move, delta_turn)
+
+    def update_batch(self, timestamps, left_moves, right_moves, headings=None):
+        '''
+        Integrate a whole sequence of encoder deltas at once (same math as update)
+        headings (absolute, radians) replace the turn found from the wheels if given
+        Returns arrays of x, y, theta after each sample and leaves the pose at the last one
+        '''
+        timestamps = np.asarray(timestamps, dtype=float)
+        left_moves = np.asarray(left_moves, dtype=float)
+        right_moves = np.asarray(right_moves, dtype=float)
+
+        delta_move = (left_moves + right_moves) / 2
+        delta_turn = (right_moves - left_moves) / self.track_width
+        if headings is not None:
+            delta_turn = _heading_turns(headings, self._last_heading, delta_turn)
+        if len(timestamps):
+            self._last_heading = None if headings is None else float(headings[-1])
+        x, y, theta = _integrate(self.pose.x, self.pose.y, self.pose.theta, delta_move, delta_turn)
+        theta %= 2 * pi
+
+        if len(timestamps):
+            delta_time = timestamps[-1] - (timestamps[-2] if len(timestamps) > 1 else self.previous_time)
+            self.pose(x[-1], y[-1], theta[-1])
+            self.pose.x_vel = delta_move[-1] / delta_time if delta_time > 0 else 0
+            self.pose.y_vel = 0
+            self.pose.theta_vel = delta_turn[-1] / delta_time if delta_time > 0 else 0
+            self.previous_time = timestamps[-1]
+            self.history.extend(timestamps, x, y, theta, delta_move, delta_turn)
+        return x, y, theta
+
+    def replay(self, timestamps, left_moves, right_moves, headings=None, pose=(0, 0, 0)):
+        '''
+        Integrate a logged match from the starting pose
+        '''
+        self.pose(*pose)
+        self._last_heading = None
+        self.previous_time = timestamps[0] if len(timestamps) else now()
+        self.history.clear()
+        return self.update_batch(timestamps, left_moves, right_moves, headings)
+
+    def pose_at(self, timestamp):
+        '''
+        Where the robot was at timestamp (interpolated from the history)
+        '''
+        return self.history.sample(timestamp)
+
+    def apply_correction(self, timestamp, x, y, theta=None):
+        '''
+        Fix the pose at an earlier timestamp (ie from a late vision measurement)
+        Every move recorded after it is replayed from the corrected pose
+        Returns False if timestamp is older than the history
+        '''
+        history = self.history
+        i = history.find(timestamp)
+        if i == 0:
+            return False
+        if theta is None:
+            theta = history.sample(timestamp)[2]
+
+        theta %= 2 * pi
+        previous_time = history.get(i - 1)[0]
+        times, _, _, _, moves, turns = history.columns(i)
+        if len(times):  # the first sample after the correction only gets the part of its move after timestamp
+            span = times[0] - previous_time
+            fraction = (times[0] - timestamp) / span if span > 0 else 1
+            moves[0] *= fraction
+            turns[0] *= fraction
+        new_x, new_y, new_theta = _integrate(x, y, theta, moves, turns)
+        new_theta %= 2 * pi
+        if previous_time == timestamp:  # the correction lands exactly on a sample
+            i -= 1
+            new_x, new_y, new_theta = np.r_[x, new_x], np.r_[y, new_y], np.r_[theta, new_theta]
+        history.rewrite(i, new_x, new_y, new_theta)
+        if len(new_x):
+            x, y, theta = new_x[-1], new_y[-1], new_theta[-1]
+        self.pose(x, y, theta)
+        return True
 
     def reset(self):
-        self.pose = Pose(0, 0, 0)
+        self._last_heading = None
+        self.pose(0, 0, 0)
+        self.pose.x_vel, self.pose.y_vel, self.pose.theta_vel = 0, 0, 0
+        self.history.clear()
+
 
 
-class Gyro:  # todo: find a way to do this
+def _integrate_twists(x, y, theta, dx, dy, dtheta):
     '''
-    Wrapper class for a gyroscope
+    Vectorized Pose.exp through arrays of robot relative twists, returns x, y, theta (not wrapped) after each
     '''
-    @property
-    def heading(self):
-        return 0
+    thetas = theta + np.cumsum(dtheta)
+    previous_theta = thetas - dtheta
+    small = np.abs(dtheta) < 1e-9
+    safe = np.where(small, 1, dtheta)
+    s = np.where(small, 1 - dtheta * dtheta / 6, np.sin(dtheta) / safe)
+    c = np.where(small, 0.5 * dtheta, (1 - np.cos(dtheta)) / safe)
+    tx, ty = dx * s - dy * c, dx * c + dy * s
+    cos_theta, sin_theta = np.cos(previous_theta), np.sin(previous_theta)
+    return x + np.cumsum(tx * cos_theta - ty * sin_theta), y + np.cumsum(tx * sin_theta + ty * cos_theta), thetas
+
+
+class HolonomicOdometry:
+    '''
+    Odometry for swerve or mecanum drives, from a SwerveKinematics or MecanumKinematics
+    Each update the wheel distances are turned into one robot relative twist (forward kinematics) and followed as an arc
+    The history's MOVE and TURN columns hold the twist's forward and turning parts
+    '''
+    def __init__(self, kinematics, pose=(0, 0, 0), history_size=512, gyro: Gyro = None):
+        self.kinematics = kinematics
+        self.pose = Pose(*pose)
+        self.previous_time = now()
+        self.history = PoseHistory(history_size)
+        self.gyro = gyro
+        self._last_heading = None
+        self._twist = Twist()
+
+    def update(self, heading, wheel_moves, module_angles=None):
+        '''
+        wheel_moves: distance each wheel went since the last update, module_angles: each swerve module's angle (swerve only)
+        heading can be None to use the gyro (if there is one) or the wheels
+        '''
+        new_time = now()
+        delta_time = new_time - self.previous_time
+        self.previous_time = new_time
+
+        twist = self._twist
+        if module_angles is None:
+            self.kinematics.chassis_speeds(wheel_moves, twist)
+        else:
+            self.kinematics.chassis_speeds_from_states(np.asarray(wheel_moves, dtype=float), np.asarray(module_angles, dtype=float), twist)
+        if heading is None and self.gyro is not None:
+            heading = self.gyro.heading
+        if heading is not None and self._last_heading is not None:
+            twist.dtheta = wrap_angle(heading - self._last_heading)
+        self._last_heading = heading
+
+        self.pose.exp(twist)
+        self.pose.theta %= 2 * pi
+        self.pose.x_vel = twist.dx / delta_time if delta_time > 0 else 0
+        self.pose.y_vel = twist.dy / delta_time if delta_time > 0 else 0
+        self.pose.theta_vel = twist.dtheta / delta_time if delta_time > 0 else 0
+        self.history.add(new_time, self.pose.x, self.pose.y, self.pose.theta, twist.dx, twist.dtheta)
+
+    def update_batch(self, timestamps, wheel_moves, module_angles=None, headings=None):
+        '''
+        Integrate (samples, wheels) arrays of wheel distances (and swerve module angles) at once
+        Returns arrays of x, y, theta after each sample and leaves the pose at the last one
+        '''
+        timestamps = np.asarray(timestamps, dtype=float)
+        wheel_moves = np.asarray(wheel_moves, dtype=float)
+        if module_angles is None:
+            dx, dy, dtheta = self.kinematics.chassis_speeds_batch(wheel_moves)
+        else:
+            dx, dy, dtheta = self.kinematics.chassis_speeds_batch_from_states(wheel_moves, np.asarray(module_angles, dtype=float))
+        if headings is not None:
+            dtheta = _heading_turns(headings, self._last_heading, dtheta)
+        if len(timestamps):
+            self._last_heading = None if headings is None else float(headings[-1])
+        x, y, theta = _integrate_twists(self.pose.x, self.pose.y, self.pose.theta, dx, dy, dtheta)
+        theta %= 2 * pi
+        if len(timestamps):
+            self.pose(x[-1], y[-1], theta[-1])
+            self.previous_time = timestamps[-1]
+            self.history.extend(timestamps, x, y, theta, dx, dtheta)
+        return x, y, theta
+
+    def pose_at(self, timestamp):
+        return self.history.sample(timestamp)
+
+    def reset(self):
+        self._last_heading = None
+        self.pose(0, 0, 0)
+        self.pose.x_vel, self.pose.y_vel, self.pose.theta_vel = 0, 0, 0
+        self.history.clear()
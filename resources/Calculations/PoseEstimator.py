@@ -0,0 +1,255 @@
+from math import cos, sin, pi
+import numpy as np
+from resources.Calculations.Geometry import Pose, wrap_angle
+from resources.Structure.Clock import now
+
+'''
+Extended Kalman filter for the robot's pose (x, y, theta) fusing wheel odometry, the gyro and late vision measurements
+Everything is preallocated, a predict is a few in place 3x3 operations and an update is a 3x3 solve
+'''
+
+
+class PoseEstimator:
+    '''
+    predict with each odometry move and turn, update with gyro headings and (timestamped, late) vision poses
+    Vision measurements are applied at the time they were taken: the filter rewinds to it and replays the moves and gyro
+    headings since
+    Noise is in standard deviations: move_noise (per meter driven), turn_noise (rad per meter driven and per rad turned)
+    '''
+    def __init__(self, pose=(0, 0, 0), move_noise=0.02, turn_noise=0.02, gyro_noise=0.02, vision_noise=(0.1, 0.1, 0.1),
+                 initial_noise=(0.01, 0.01, 0.01), history_size=256):
+        self.move_variance = move_noise ** 2
+        self.turn_variance = turn_noise ** 2
+        self.gyro_variance = gyro_noise ** 2
+        self.vision_covariance = np.diag(np.square(vision_noise).astype(float))
+
+        self.initial_covariance = np.diag(np.square(initial_noise).astype(float))
+        self.state = np.array(pose, dtype=float)
+        self.covariance = self.initial_covariance.copy()
+
+        # history to rewind to for late measurements: each predict's move and turn, the gyro heading applied after it
+        # (nan if none) and the state after both, so a replay redoes the gyro corrections too
+        self.history_size = history_size
+        self._times = np.zeros(history_size)
+        self._moves = np.zeros((history_size, 2))
+        self._headings = np.full((history_size, 2), np.nan)  # heading, variance
+        self._states = np.zeros((history_size, 3))
+        self._covariances = np.zeros((history_size, 3, 3))
+        self._count = 0  # predicts recorded, the newest is at (count - 1) % history_size
+        self.rejected = 0  # vision measurements too old for the history
+
+        # scratch space so predict and update don't allocate
+        self._jacobian = np.eye(3)
+        self._temp = np.zeros((3, 3))
+        self._innovation = np.zeros(3)
+        self._gain = np.zeros((3, 3))
+        self._identity = np.eye(3)
+        self._heading_gain = np.zeros(3)
+        self._heading_step = np.zeros(3)
+        # views into the preallocated arrays (covariance is only ever written in place, so these stay valid)
+        self._heading_column = self.covariance[:, 2]
+        self._heading_row = self.covariance[2]
+        self._heading_gain_column = self._heading_gain[:, None]
+
+    @property
+    def pose(self):
+        x, y, theta = self.state.tolist()
+        return Pose(x, y, theta % (2 * pi))
+
+    def reset(self, pose=(0, 0, 0)):
+        '''
+        Start over from pose with the initial uncertainty and an empty history
+        '''
+        self.state[:] = pose
+        self.covariance[:] = self.initial_covariance
+        self._headings[:] = np.nan
+        self._count = 0
+
+    def _predict(self, move, turn):
+        state, covariance, jacobian, temp = self.state, self.covariance, self._jacobian, self._temp
+        x, y, theta = state.tolist()
+        middle = theta + turn / 2  # the arc's average heading
+        c, s = cos(middle), sin(middle)
+        state[0], state[1], state[2] = x + move * c, y + move * s, theta + turn
+
+        jacobian[0, 2], jacobian[1, 2] = -move * s, move * c
+        np.matmul(jacobian, covariance, out=temp)
+        np.matmul(temp, jacobian.T, out=covariance)
+        # noise grows with the distance driven and how much it turned, along and across the direction of travel
+        distance = abs(move)
+        along = self.move_variance * distance
+        across = self.turn_variance * distance * move * move / 4  # heading error while driving moves it sideways
+        turn_variance = self.turn_variance * (distance + abs(turn))
+        covariance[0, 0] += along * c * c + across * s * s
+        covariance[1, 1] += along * s * s + across * c * c
+        covariance[0, 1] += (along - across) * c * s
+        covariance[1, 0] = covariance[0, 1]
+        covariance[2, 2] += turn_variance
+
+    def predict(self, move, turn, time=None):
+        '''
+        Move the estimate by an odometry step (distance forward and radians turned since the last predict)
+        '''
+        self._predict(move, turn)
+        i = self._count % self.history_size
+        self._times[i] = now() if time is None else time
+        self._moves[i] = move, turn
+        self._headings[i] = np.nan
+        self._states[i] = self.state
+        self._covariances[i] = self.covariance
+        self._count += 1
+
+    def predict_from(self, odometry):
+        '''
+        predict with the newest step an Odometry recorded
+        '''
+        time, _, _, _, move, turn = odometry.history.get(len(odometry.history) - 1)
+        self.predict(move, turn, time)
+
+    def update_heading(self, heading, variance=None):
+        '''
+        Correct with an absolute heading (ie the gyro's)
+        '''
+        variance = self.gyro_variance if variance is None else variance
+        self._update_heading(heading, variance)
+        if self._count:  # remember it so a late vision update can replay it
+            i = (self._count - 1) % self.history_size
+            previous, previous_variance = self._headings[i].tolist()
+            if previous_variance == previous_variance:  # already one this step, store the two as one combined reading
+                heading = previous + wrap_angle(heading - previous)
+                heading, variance = ((previous * variance + heading * previous_variance) / (previous_variance + variance),
+                                     previous_variance * variance / (previous_variance + variance))
+            self._headings[i] = heading, variance
+            self._states[i] = self.state
+            self._covariances[i] = self.covariance
+
+    def _update_heading(self, heading, variance):
+        state, covariance, gain, step = self.state, self.covariance, self._heading_gain, self._heading_step
+        innovation = wrap_angle(heading - state[2])
+        np.multiply(self._heading_column, 1 / (covariance[2, 2] + variance), out=gain)
+        np.multiply(gain, innovation, out=step)
+        state += step
+        np.multiply(self._heading_gain_column, self._heading_row, out=self._temp)
+        covariance -= self._temp
+
+    def _update_pose(self, x, y, theta, covariance_noise):
+        state, covariance, innovation, gain = self.state, self.covariance, self._innovation, self._gain
+        innovation[0], innovation[1], innovation[2] = x - state[0], y - state[1], wrap_angle(theta - state[2])
+        np.add(covariance, covariance_noise, out=self._temp)
+        gain[:] = np.linalg.solve(self._temp, covariance).T  # covariance @ inverse(covariance + noise), both symmetric
+        state += gain @ innovation
+        np.subtract(self._identity, gain, out=self._temp)
+        np.matmul(self._temp, covariance, out=gain)
+        covariance[:] = gain
+
+    def update_vision(self, time, x, y, theta, noise=None):
+        '''
+        Correct with a pose measured at time (in the past), replaying the moves since then
+        noise is (x, y, theta) standard deviations for this measurement, returns False if it is older than the history
+        '''
+        noise_covariance = self.vision_covariance if noise is None else np.diag(np.square(noise).astype(float))
+        count, size = self._count, self.history_size
+        oldest = max(0, count - size)
+        # newest predict at or before time (binary search over the ring)
+        low, high = oldest, count
+        while low < high:
+            middle = (low + high) // 2
+            if self._times[middle % size] <= time:
+                low = middle + 1
+            else:
+                high = middle
+        if low == oldest and count > 0:  # taken before anything still in the history
+            self.rejected += 1
+            return False
+        if low > oldest:  # rewind to the estimate at the measurement
+            i = (low - 1) % size
+            self.state[:] = self._states[i]
+            self.covariance[:] = self._covariances[i]
+        self._update_pose(x, y, theta, noise_covariance)
+        if low > oldest:
+            self._states[(low - 1) % size] = self.state
+            self._covariances[(low - 1) % size] = self.covariance
+        for index in range(low, count):  # replay, rewriting the history with the corrected estimates
+            i = index % size
+            self._predict(*self._moves[i].tolist())
+            heading, variance = self._headings[i].tolist()
+            if variance == variance:  # not nan, a gyro heading was applied after this predict
+                self._update_heading(heading, variance)
+            self._states[i] = self.state
+            self._covariances[i] = self.covariance
+        return True
+
+
+def replay(times, moves, turns, headings=None, vision=None, estimator=None):
+    '''
+    Run the filter over a recorded log as fast as possible (ie columns from Telemetry's open_log)
+    headings: gyro heading at each time (or None)
+    vision: (times, x, y, theta) arrays of measurements, plus optionally when each one arrived (the time it was taken otherwise)
+    Returns x, y, theta arrays of the estimate after each step
+    '''
+    estimator = PoseEstimator() if estimator is None else estimator
+    count = len(times)
+    out = np.empty((count, 3))
+    vision = [] if vision is None else [np.asarray(column).tolist() for column in vision]
+    vision_times, vision_x, vision_y, vision_theta = vision[:4] if vision else ((), (), (), ())
+    arrival = vision[4] if len(vision) > 4 else vision_times
+    times, moves, turns = np.asarray(times).tolist(), np.asarray(moves).tolist(), np.asarray(turns).tolist()
+    headings = None if headings is None else np.asarray(headings).tolist()
+    next_vision = 0
+    for step in range(count):
+        time = times[step]
+        estimator.predict(moves[step], turns[step], time)
+        if headings is not None:
+            estimator.update_heading(headings[step])
+        while next_vision < len(vision_times) and arrival[next_vision] <= time:
+            estimator.update_vision(vision_times[next_vision], vision_x[next_vision], vision_y[next_vision], vision_theta[next_vision])
+            next_vision += 1
+        out[step] = estimator.state
+    return out[:, 0], out[:, 1], out[:, 2]
+
+
+if __name__ == "__main__":  # a noisy simulated drive: dead reckoning against the filter, and the time per step
+    import time as timer
+
+    rng = np.random.default_rng(0)
+    steps, period, latency = 3000, 0.02, 0.1
+    times = np.arange(1, steps + 1) * period
+    true_moves = np.full(steps, 1.5 * period)
+    true_turns = 0.6 * np.sin(times / 3) * period
+    x, y, theta = [0.0], [0.0], [0.0]
+    for move, turn in zip(true_moves, true_turns):
+        middle = theta[-1] + turn / 2
+        x.append(x[-1] + move * cos(middle))
+        y.append(y[-1] + move * sin(middle))
+        theta.append(theta[-1] + turn)
+    x, y, theta = np.array(x[1:]), np.array(y[1:]), np.array(theta[1:])
+
+    moves = true_moves * 1.03 + rng.normal(0, 0.002, steps)  # wheels slip a bit
+    turns = true_turns + 0.002 + rng.normal(0, 0.002, steps)
+    headings = theta + rng.normal(0, 0.01, steps)
+    every = 5  # vision at 10hz, arriving latency seconds after it was taken
+    vision = (times[::every], x[::every] + rng.normal(0, 0.05, steps // every), y[::every] + rng.normal(0, 0.05, steps // every),
+              theta[::every] + rng.normal(0, 0.05, steps // every), times[::every] + latency)
+
+    # gyro updates interleaved with a late vision update: rewinding must redo the gyro corrections, so a late fix that
+    # agrees with the gyro leaves the heading where it was, and gives the same result as applying it on time
+    live, late = PoseEstimator(gyro_noise=0.001), PoseEstimator(gyro_noise=0.001)
+    for step in range(1, 41):
+        for estimator in (live, late):
+            estimator.predict(0.02, 0.01, step * period)  # the wheels think it is turning, the gyro says it isn't
+            estimator.update_heading(0.0)
+        if step == 25:
+            live.update_vision(step * period, 0.5, 0, 0)
+    late.update_vision(25 * period, 0.5, 0, 0)
+    assert abs(late.state[2]) < 0.01 and np.allclose(live.state, late.state) and np.allclose(live.covariance, late.covariance)
+    print(f"late vision with gyro replay: heading {late.state[2]:.4f} rad, matches applying it on time")
+
+    dead_x, dead_y, _ = replay(times, moves, turns)
+    start = timer.perf_counter()
+    estimate_x, estimate_y, _ = replay(times, moves, turns, headings, vision)
+    elapsed = timer.perf_counter() - start
+    dead_error = np.hypot(dead_x - x, dead_y - y)
+    error = np.hypot(estimate_x - x, estimate_y - y)
+    print(f"{steps} steps ({steps * period:.0f}s): dead reckoning final error {dead_error[-1]:.2f} m, "
+          f"filter final {error[-1]:.3f} m (rms {np.sqrt(np.mean(error ** 2)):.3f} m)")
+    print(f"{elapsed / steps * 1e6:.1f} us per step (predict + gyro update, + a vision update with replay every {every})")
@@ -1,24 +1,149 @@
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+import numpy as np
+
+
 class Interpolator:
     """
     Why do math when you can guess and check
+    Linear interpolation between sorted (key, value) points, ie shooter speed by distance
+    Outside the keys it returns the value of the nearest end
     """
-    def __init__(self, dictionary):
-        self.dictionary = dictionary
+    def __init__(self, dictionary=None, memoize=0):
+        self.memoize = memoize  # how many recent scalar queries to remember (0 is off)
+        self._cache = OrderedDict()
+        self.dictionary = dictionary or {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    @property
+    def dictionary(self):
+        '''
+        The points as {key: value} (a copy, insert or set this to change them)
+        '''
+        return dict(zip(self._keys, self._values))
+
+    @dictionary.setter
+    def dictionary(self, dictionary):
+        items = sorted(dictionary.items())
+        self._keys = [float(key) for key, _ in items]
+        self._values = [float(value) for _, value in items]
+        self._arrays = None  # numpy copies for estimating arrays, rebuilt after an insert
+        self._cache.clear()
+
+    @property
+    def keys(self):
+        return self._numpy()[0]
+
+    @property
+    def values(self):
+        return self._numpy()[1]
+
+    def _numpy(self):
+        if self._arrays is None:
+            self._arrays = np.array(self._keys), np.array(self._values)
+        return self._arrays
+
+    def insert(self, key, value):
+        '''
+        Add a point (or replace the value at key)
+        '''
+        key, value = float(key), float(value)
+        i = bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            self._values[i] = value
+        else:
+            self._keys.insert(i, key)
+            self._values.insert(i, value)
+        self._arrays = None
+        self._cache.clear()
+
+    __setitem__ = insert
+
+    def __getitem__(self, point):
+        return self.estimate(point)
 
     def estimate(self, point):
-        previous_item = None
-        for item in self.dictionary:
-            # if you
-            if item < point:
-                previous_item = item
-                continue
-            if item == point: return self.dictionary[point]  # if exactly equal to datum
-            if previous_item is None: return self.dictionary[point]  # if lower then lowest datum
+        if not self._keys:
+            raise ValueError("Interpolator has no points to estimate from")
+        if isinstance(point, (np.ndarray, list, tuple)):
+            keys, values = self._numpy()
+            return np.interp(point, keys, values)  # clamps to the end values the same way
+        if self.memoize:
+            cached = self._cache.get(point)
+            if cached is not None:
+                self._cache.move_to_end(point)
+                return cached
+        result = self._estimate(point)
+        if self.memoize:
+            self._cache[point] = result
+            if len(self._cache) > self.memoize:
+                self._cache.popitem(last=False)
+        return result
 
-            nearest_vals = self.dictionary[previous_item], self.dictionary[previous_item]  # the value of low and high point
-            distances = point-previous_item, point-item  # how far the point is from each datum
-            return weighted_average(values=nearest_vals, weights=distances)
-        return self.dictionary.vals()[-1]  # higher than highest datum
+    def _estimate(self, point):
+        keys, values = self._keys, self._values
+        i = bisect_right(keys, point)
+        if i == 0: return values[0]  # if lower then lowest datum
+        if i == len(keys): return values[-1]  # higher than highest datum
+        low, high = keys[i - 1], keys[i]
+        fraction = (point - low) / (high - low)
+        return values[i - 1] + (values[i] - values[i - 1]) * fraction
+
+
+class Interpolator2D:
+    """
+    Bilinear interpolation over a grid: table[i][j] is the value at (xs[i], ys[j]), ie shooter speed by distance and angle
+    Clamped to the edges of the grid like Interpolator
+    """
+    def __init__(self, xs, ys, table):
+        self.xs = np.asarray(xs, dtype=float)
+        self.ys = np.asarray(ys, dtype=float)
+        self.table = np.asarray(table, dtype=float)
+        if self.table.shape != (len(self.xs), len(self.ys)):
+            raise ValueError(f"table should be {len(self.xs)} by {len(self.ys)}, not {self.table.shape}")
+        order_x, order_y = np.argsort(self.xs), np.argsort(self.ys)
+        self.xs, self.ys, self.table = self.xs[order_x], self.ys[order_y], self.table[order_x][:, order_y]
+        self._xs, self._ys, self._rows = self.xs.tolist(), self.ys.tolist(), self.table.tolist()
+
+    @staticmethod
+    def _cell(keys, point):
+        '''
+        Index of the lower key and the fraction to the next, clamped to the ends
+        '''
+        i = bisect_right(keys, point) - 1
+        if i < 0: return 0, 0.0
+        if i >= len(keys) - 1: return max(len(keys) - 2, 0), 1.0 if len(keys) > 1 else 0.0
+        return i, (point - keys[i]) / (keys[i + 1] - keys[i])
+
+    def estimate(self, x, y):
+        if isinstance(x, (np.ndarray, list, tuple)) or isinstance(y, (np.ndarray, list, tuple)):
+            return self._estimate_array(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        i, fx = self._cell(self._xs, x)
+        j, fy = self._cell(self._ys, y)
+        rows = self._rows
+        low, high = rows[i], rows[min(i + 1, len(rows) - 1)]
+        j1 = min(j + 1, len(low) - 1)
+        bottom = low[j] + (low[j1] - low[j]) * fy
+        top = high[j] + (high[j1] - high[j]) * fy
+        return bottom + (top - bottom) * fx
+
+    def _estimate_array(self, x, y):
+        def cells(keys, points):
+            last = len(keys) - 1
+            if last == 0:
+                return np.zeros(points.shape, dtype=np.intp), np.zeros(points.shape), np.zeros(points.shape, dtype=np.intp)
+            points = np.clip(points, keys[0], keys[-1])
+            i = np.clip(np.searchsorted(keys, points, side='right') - 1, 0, last - 1)
+            return i, (points - keys[i]) / (keys[i + 1] - keys[i]), i + 1
+        x, y = np.broadcast_arrays(x, y)
+        i, fx, i1 = cells(self.xs, x)
+        j, fy, j1 = cells(self.ys, y)
+        table = self.table
+        bottom = table[i, j] + (table[i, j1] - table[i, j]) * fy
+        top = table[i1, j] + (table[i1, j1] - table[i1, j]) * fy
+        return bottom + (top - bottom) * fx
 
 
 def coerce(min, max, val):
@@ -36,4 +161,30 @@ def average(*args):
 
 
 def weighted_average(values, weights):
-    return sum(value * weight for value, weight in zip(values, weights))
\ No newline at end of file
+    return sum(value * weight for value, weight in zip(values, weights))
+
+if __name__ == "__main__":  # lookups in a big table, against the old linear scan
+    import timeit
+
+    def old_estimate(dictionary, point):  # the old Interpolator.estimate with its neighbour fixed
+        previous_item = None
+        for item in dictionary:
+            if item < point:
+                previous_item = item
+                continue
+            if item == point or previous_item is None: return dictionary[item]
+            fraction = (point - previous_item) / (item - previous_item)
+            return dictionary[previous_item] + (dictionary[item] - dictionary[previous_item]) * fraction
+        return dictionary[previous_item]
+
+    n = 20000
+    table = {i * 0.001: (i * 0.001) ** 2 for i in range(n)}
+    interpolator = Interpolator(table, memoize=64)
+    queries = np.random.default_rng(0).uniform(-1, n * 0.001 + 1, 10000)
+    assert abs(interpolator.estimate(7.0005) - old_estimate(table, 7.0005)) < 1e-9
+    old = timeit.timeit(lambda: old_estimate(table, 15.1234), number=200) / 200
+    new = timeit.timeit(lambda: interpolator._estimate(15.1234), number=100000) / 100000
+    cached = timeit.timeit(lambda: interpolator.estimate(15.1234), number=100000) / 100000
+    batch = timeit.timeit(lambda: interpolator.estimate(queries), number=100) / 100
+    print(f"{n} points: scan {old * 1e6:.0f} us, bisect {new * 1e6:.2f} us, memoized {cached * 1e6:.2f} us, "
+          f"{len(queries)} at once {batch / len(queries) * 1e9:.0f} ns each")
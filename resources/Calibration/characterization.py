@@ -0,0 +1,143 @@
+import numpy as np
+from resources.Calculations.Kinematics import Feedforward
+from resources.Interfaces.Motors import MotorController
+from resources.Structure.Clock import now, sleep
+from resources.Structure.Scheduler import Scheduler
+
+'''
+Drive characterization (like WPILib's SysId)
+Ramps the voltage slowly (quasistatic) and steps it (dynamic) while logging, then fits
+voltage = ks * sign(velocity) + kv * velocity + ka * acceleration
+'''
+
+
+class DriveLog:
+    '''
+    Preallocated buffers of time, voltage, velocity and position samples
+    '''
+    TIME, VOLTAGE, VELOCITY, POSITION = range(4)
+
+    def __init__(self, capacity):
+        self.data = np.zeros((4, capacity))
+        self.count = 0
+        self.dropped = 0  # samples that didn't fit
+
+    def __len__(self):
+        return self.count
+
+    def record(self, time, voltage, velocity, position):
+        if self.count == self.data.shape[1]:
+            self.dropped += 1
+            return
+        column = self.data[:, self.count]
+        column[0], column[1], column[2], column[3] = time, voltage, velocity, position
+        self.count += 1
+
+    def columns(self):
+        '''
+        Views of the recorded time, voltage, velocity and position
+        '''
+        return self.data[:, :self.count]
+
+
+def _axis_reading(value, axis):
+    '''
+    One axis' reading from a motor that may control several (their speed and position are lists)
+    '''
+    return value[axis] if isinstance(value, (list, tuple)) else value
+
+
+def run_test(motor: MotorController, voltage, duration, period=0.005, log=None, axis=0):
+    '''
+    Drive motor with voltage(t) for duration seconds, logging every period
+    A motor with several axes drives them all and logs the one at index axis
+    Returns the log and the number of samples missed because a tick overran
+    '''
+    log = DriveLog(int(duration / period) + 2) if log is None else log
+    scheduler = Scheduler(period)
+    start = now()  # the scheduler's clock, so a simulated test times out on simulated time
+
+    def step():
+        t = now() - start
+        if t >= duration:
+            scheduler.stop()
+            return
+        volts = voltage(t)
+        motor.voltage = volts
+        motor.flush()
+        log.record(t, volts, _axis_reading(motor.speed, axis), _axis_reading(motor.position, axis))
+    scheduler.add(step)
+    try:
+        scheduler.run()
+    finally:
+        motor.voltage = 0
+        motor.flush()
+    return log, scheduler.missed
+
+
+def quasistatic(motor: MotorController, ramp_rate=0.25, max_voltage=6, direction=1, period=0.005, axis=0):
+    '''
+    Ramp the voltage slowly so acceleration is ~0 and only ks and kv matter
+    '''
+    duration = max_voltage / ramp_rate
+    return run_test(motor, lambda t: direction * ramp_rate * t, duration, period, axis=axis)
+
+
+def dynamic(motor: MotorController, step_voltage=4, duration=2, direction=1, period=0.005, axis=0):
+    '''
+    Step the voltage so the acceleration is large enough to find ka
+    '''
+    return run_test(motor, lambda t: direction * step_voltage, duration, period, axis=axis)
+
+
+def fit_feedforward(voltages, velocities, accelerations, min_velocity=0.01):
+    '''
+    Least squares fit of ks, kv and ka over any number of samples
+    Returns the Feedforward and the fit quality (r squared and rms error in volts)
+    '''
+    voltages, velocities, accelerations = (np.asarray(column, dtype=float) for column in (voltages, velocities, accelerations))
+    moving = np.abs(velocities) > min_velocity  # ks only applies once it is moving
+    voltages, velocities, accelerations = voltages[moving], velocities[moving], accelerations[moving]
+
+    inputs = np.column_stack((np.sign(velocities), velocities, accelerations))
+    gains, _, _, _ = np.linalg.lstsq(inputs, voltages, rcond=None)
+    residuals = voltages - inputs @ gains
+    total = np.sum((voltages - voltages.mean()) ** 2)
+    quality = {
+        "r_squared": float(1 - np.sum(residuals ** 2) / total) if total > 0 else 1.0,
+        "rms_error": float(np.sqrt(np.mean(residuals ** 2))),
+        "samples": int(moving.sum()),
+    }
+    return Feedforward(*map(float, gains)), quality
+
+
+def fit_logs(logs, min_velocity=0.01):
+    '''
+    Fit over several DriveLogs, the acceleration is found within each log so it never spans two tests
+    '''
+    voltages, velocities, accelerations = [], [], []
+    for log in logs:
+        times, voltage, velocity, _ = log.columns()
+        voltages.append(voltage)
+        velocities.append(velocity)
+        accelerations.append(np.gradient(velocity, times))
+    return fit_feedforward(np.concatenate(voltages), np.concatenate(velocities), np.concatenate(accelerations), min_velocity)
+
+
+def characterize(motor: MotorController, ramp_rate=0.25, max_voltage=6, step_voltage=4, step_duration=2, period=0.005, rest=2,
+                 axis=0):
+    '''
+    Run the quasistatic and dynamic tests both ways and fit a Feedforward to all of them
+    The robot needs room to drive a few meters each way, axis picks which one is logged on a multi axis motor
+    '''
+    logs, missed = [], 0
+    for direction in (1, -1):
+        for test in (lambda: quasistatic(motor, ramp_rate, max_voltage, direction, period, axis),
+                     lambda: dynamic(motor, step_voltage, step_duration, direction, period, axis)):
+            log, test_missed = test()
+            logs.append(log)
+            missed += test_missed
+            sleep(rest)  # let it stop before the next test
+    feedforward, quality = fit_logs(logs)
+    quality["missed"] = missed
+    return feedforward, quality
@@ -0,0 +1,214 @@
+import hashlib, os, struct
+from math import cos, sin, hypot, pi, sqrt
+import numpy as np
+
+'''
+Trajectory generation (like WPILib's TrajectoryGenerator / PathWeaver)
+Waypoints are joined with quintic hermite splines, then a velocity profile is fit under the config's limits
+Generating takes a while, so trajectories are cached to disk and memory mapped when loaded
+'''
+
+
+class TrajectoryConfig:
+    '''
+    Limits for a trajectory: max velocity (m/s), acceleration (m/s^2) and centripetal acceleration (m/s^2)
+    '''
+    def __init__(self, max_velocity, max_acceleration, max_centripetal=None, start_velocity=0, end_velocity=0, resolution=0.02):
+        self.max_velocity = max_velocity
+        self.max_acceleration = max_acceleration
+        self.max_centripetal = max_centripetal
+        self.start_velocity = start_velocity
+        self.end_velocity = end_velocity
+        self.resolution = resolution  # rough distance between points on the path (m)
+
+    def key(self):
+        return (self.max_velocity, self.max_acceleration, self.max_centripetal or 0,
+                self.start_velocity, self.end_velocity, self.resolution)
+
+
+class State:
+    '''
+    Where the robot should be at a point in time
+    '''
+    __slots__ = ('time', 'x', 'y', 'theta', 'velocity', 'acceleration', 'curvature')
+
+    def __init__(self, time=0, x=0, y=0, theta=0, velocity=0, acceleration=0, curvature=0):
+        self.time, self.x, self.y, self.theta = time, x, y, theta
+        self.velocity, self.acceleration, self.curvature = velocity, acceleration, curvature
+
+    def __repr__(self):
+        return f"State(t={self.time:.3f}, x={self.x:.3f}, y={self.y:.3f}, theta={self.theta:.3f}, v={self.velocity:.3f})"
+
+
+class Trajectory:
+    '''
+    A time parameterized path, stored as one row per field so it can be saved and memory mapped as is
+    '''
+    TIME, X, Y, THETA, VELOCITY, ACCELERATION, CURVATURE = range(7)
+
+    def __init__(self, data):
+        self.data = data.view(np.ndarray) if isinstance(data, np.memmap) else data  # (7, n), still backed by the file
+        self.times = self.data[self.TIME]
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    @property
+    def total_time(self):
+        return float(self.times[-1])
+
+    def sample(self, time, out=None):
+        '''
+        The state at time (interpolated, binary search), clamped to the start and end
+        '''
+        out = State() if out is None else out
+        data = self.data
+        i = int(np.searchsorted(self.times, time, side='right'))
+        if i == 0:
+            i, fraction = 1, 0
+        elif i == len(self.times):
+            i, fraction = i - 1, 1
+        else:
+            t0, t1 = self.times[i - 1], self.times[i]
+            fraction = (time - t0) / (t1 - t0) if t1 > t0 else 1
+        (_, x0, y0, theta0, v0, a0, k0), (_, x1, y1, theta1, v1, a1, k1) = data[:, i - 1:i + 1].T.tolist()
+        out.time = time
+        out.x = x0 + (x1 - x0) * fraction
+        out.y = y0 + (y1 - y0) * fraction
+        out.theta = theta0 + ((theta1 - theta0 + pi) % (2 * pi) - pi) * fraction
+        out.velocity = v0 + (v1 - v0) * fraction
+        out.acceleration = a0 if fraction < 1 else a1
+        out.curvature = k0 + (k1 - k0) * fraction
+        return out
+
+    def save(self, path):
+        np.save(path, np.ascontiguousarray(self.data))
+
+    @classmethod
+    def load(cls, path):
+        return cls(np.load(path, mmap_mode='r'))
+
+
+def _spline_points(waypoints, resolution):
+    '''
+    Points along quintic hermite splines through the waypoints: x, y, heading and curvature arrays
+    '''
+    xs, ys, headings, curvatures = [], [], [], []
+    for i, ((x0, y0, theta0), (x1, y1, theta1)) in enumerate(zip(waypoints, waypoints[1:])):
+        scale = hypot(x1 - x0, y1 - y0)  # tangent length, longer makes the path straighter near the waypoints
+        coefficients = []
+        for p0, p1, v0, v1 in ((x0, x1, scale * cos(theta0), scale * cos(theta1)),
+                               (y0, y1, scale * sin(theta0), scale * sin(theta1))):
+            coefficients.append(np.array([
+                -6 * p0 - 3 * v0 - 3 * v1 + 6 * p1,
+                15 * p0 + 8 * v0 + 7 * v1 - 15 * p1,
+                -10 * p0 - 6 * v0 - 4 * v1 + 10 * p1,
+                0, v0, p0]))  # highest power first for np.polyval
+        count = max(2, int(np.ceil(scale / resolution)) + 1)
+        u = np.linspace(0, 1, count)[(1 if i else 0):]  # the first point of a segment is the last of the one before
+        (x, dx, ddx), (y, dy, ddy) = ((np.polyval(c, u), np.polyval(np.polyder(c), u), np.polyval(np.polyder(c, 2), u))
+                                      for c in coefficients)
+        xs.append(x)
+        ys.append(y)
+        headings.append(np.arctan2(dy, dx))
+        curvatures.append((dx * ddy - dy * ddx) / np.maximum(dx * dx + dy * dy, 1e-12) ** 1.5)
+    return np.concatenate(xs), np.concatenate(ys), np.concatenate(headings), np.concatenate(curvatures)
+
+
+def generate_trajectory(waypoints, config: TrajectoryConfig):
+    '''
+    Fit a trajectory through waypoints [(x, y, theta), ...] that respects the config's limits
+    '''
+    x, y, theta, curvature = _spline_points([tuple(map(float, point)) for point in waypoints], config.resolution)
+    distances = np.hypot(np.diff(x), np.diff(y))
+
+    # fastest speed at each point: the velocity limit, or slower if it is turning hard
+    limits = np.full(len(x), float(config.max_velocity))
+    if config.max_centripetal:
+        with np.errstate(divide='ignore'):
+            limits = np.minimum(limits, np.sqrt(config.max_centripetal / np.abs(curvature)))
+    limits[0] = min(limits[0], config.start_velocity)
+    limits[-1] = min(limits[-1], config.end_velocity)
+
+    # accelerate as much as allowed going forward, then decelerate as much as allowed going backward
+    velocity = limits.tolist()
+    distance = distances.tolist()
+    twice_acceleration = 2 * config.max_acceleration
+    for i in range(1, len(velocity)):
+        velocity[i] = min(velocity[i], sqrt(velocity[i - 1] ** 2 + twice_acceleration * distance[i - 1]))
+    for i in range(len(velocity) - 2, -1, -1):
+        velocity[i] = min(velocity[i], sqrt(velocity[i + 1] ** 2 + twice_acceleration * distance[i]))
+    velocity = np.array(velocity)
+
+    # time to cover each piece at its average speed, constant acceleration across it
+    average_velocity = (velocity[1:] + velocity[:-1]) / 2
+    durations = np.where(average_velocity > 0, distances / np.maximum(average_velocity, 1e-12), 0)
+    times = np.concatenate(([0], np.cumsum(durations)))
+    acceleration = np.zeros(len(x))
+    acceleration[:-1] = np.where(durations > 0, np.diff(velocity) / np.maximum(durations, 1e-12), 0)
+
+    return Trajectory(np.array([times, x, y, theta, velocity, acceleration, curvature]))
+
+
+class TrajectoryCache:
+    '''
+    Trajectories saved as .npy files named by a hash of their waypoints and config
+    Loading memory maps the file, so nothing is generated (or even read) at the start of a match
+    The files go in the user's cache directory ($XDG_CACHE_HOME or ~/.cache) unless directory is given
+    '''
+    def __init__(self, directory=None):
+        if directory is None:
+            cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+            directory = os.path.join(cache, "pyfrc", "trajectories")
+        self.directory = directory
+        self._loaded = {}
+
+    @staticmethod
+    def key(waypoints, config: TrajectoryConfig):
+        values = [float(value) for point in waypoints for value in point] + [float(value) for value in config.key()]
+        return hashlib.sha1(struct.pack(f'<{len(values)}d', *values)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def get(self, waypoints, config: TrajectoryConfig):
+        '''
+        Load the trajectory, generating and saving it first if it isn't cached
+        '''
+        key = self.key(waypoints, config)
+        if key not in self._loaded:
+            path = self.path(key)
+            if not os.path.exists(path):
+                os.makedirs(self.directory, exist_ok=True)
+                generate_trajectory(waypoints, config).save(path)
+            self._loaded[key] = Trajectory.load(path)
+        return self._loaded[key]
+
+    def precompute(self, paths):
+        '''
+        Generate every (waypoints, config) ahead of time, ie before deploying
+        '''
+        for waypoints, config in paths:
+            self.get(waypoints, config)
+
+
+if __name__ == "__main__":  # compare generating to loading from the cache
+    import tempfile, time
+
+    waypoints = [(0, 0, 0), (2, 1, pi / 4), (4, 3, 0), (6, 3, -pi / 2)]
+    config = TrajectoryConfig(3, 2, max_centripetal=2)
+    start = time.perf_counter()
+    trajectory = generate_trajectory(waypoints, config)
+    generated = time.perf_counter() - start
+    cache = TrajectoryCache(tempfile.mkdtemp())
+    cache.precompute([(waypoints, config)])
+    start = time.perf_counter()
+    loaded = TrajectoryCache(cache.directory).get(waypoints, config)
+    load_time = time.perf_counter() - start
+    state = State()
+    start = time.perf_counter()
+    for i in range(10000):
+        loaded.sample(i * 0.001, state)
+    sample_time = (time.perf_counter() - start) / 10000
+    print(f"{len(trajectory)} points, {trajectory.total_time:.2f}s long")
+    print(f"generate: {generated * 1e3:.1f} ms, load: {load_time * 1e6:.0f} us, sample: {sample_time * 1e6:.1f} us")
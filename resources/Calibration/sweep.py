@@ -0,0 +1,155 @@
+import itertools, os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+'''
+Parameter sweeps across every core (ie tuning PID gains, feedforward constants, track width or Ramsete's b and zeta)
+Each run is task(parameters, shared, rng) -> {metric: number}, run in a process pool in chunks
+Big read only inputs like trajectories are put in shared memory once instead of being pickled for every run
+Every run gets its own random generator seeded from (seed, run index), so results don't depend on which worker ran it
+'''
+
+
+class SharedArray:
+    '''
+    A numpy array in shared memory, send handle to a worker and attach it there without copying
+    '''
+    def __init__(self, array):
+        array = np.ascontiguousarray(array)
+        self._memory = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        self.array = np.ndarray(array.shape, array.dtype, buffer=self._memory.buf)
+        self.array[...] = array
+        self.handle = (self._memory.name, array.shape, array.dtype.str)
+
+    @staticmethod
+    def attach(handle):
+        '''
+        The (read only) array for a handle, and the SharedMemory that has to stay referenced while it is used
+        '''
+        name, shape, dtype = handle
+        memory = shared_memory.SharedMemory(name=name)
+        array = np.ndarray(shape, np.dtype(dtype), buffer=memory.buf)
+        array.flags.writeable = False
+        return array, memory
+
+    def close(self):
+        self.array = None
+        self._memory.close()
+        self._memory.unlink()
+
+
+def grid(**values):
+    '''
+    Every combination of the given values, as columns: grid(b=[1, 2], zeta=[0.5, 0.7]) -> {"b": [1, 1, 2, 2], ...}
+    '''
+    names = list(values)
+    rows = list(itertools.product(*(values[name] for name in names)))
+    return {name: np.array([row[i] for row in rows], dtype=float) for i, name in enumerate(names)}
+
+
+_worker = {}  # set in each worker process by _initialize
+
+
+def _initialize(task, handles):
+    _worker["task"] = task
+    _worker["memory"] = []
+    shared = {}
+    for name, handle in handles.items():
+        shared[name], memory = SharedArray.attach(handle)
+        _worker["memory"].append(memory)
+    _worker["shared"] = shared
+
+
+def _run_chunk(seed, names, columns, first):
+    task, shared = _worker["task"], _worker["shared"]
+    results = []
+    for offset, row in enumerate(zip(*columns)):
+        rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(first + offset,)))
+        results.append(task(dict(zip(names, row)), shared, rng))
+    return results
+
+
+def sweep(task, parameters, shared=None, seed=0, workers=None, chunk_size=None, path=None):
+    '''
+    Run task once per row of parameters (columns of equal length, see grid) on workers processes (every core by default)
+    shared is {name: array}, which each task gets as read only views of shared memory
+    Returns {column: array} of the parameters followed by every metric, also saved to path (.npz) if given
+    '''
+    names = list(parameters)
+    columns = [np.asarray(parameters[name]) for name in names]
+    count = len(columns[0]) if columns else 0
+    workers = workers or os.cpu_count() or 1
+    chunk_size = chunk_size or max(1, count // (workers * 8))  # a few chunks per worker to even out the load
+
+    arrays = {name: SharedArray(array) for name, array in (shared or {}).items()}
+    try:
+        handles = {name: array.handle for name, array in arrays.items()}
+        with ProcessPoolExecutor(workers, initializer=_initialize, initargs=(task, handles)) as pool:
+            futures = [pool.submit(_run_chunk, seed, names, [column[first:first + chunk_size].tolist() for column in columns], first)
+                       for first in range(0, count, chunk_size)]
+            rows = [result for future in futures for result in future.result()]
+    finally:
+        for array in arrays.values():
+            array.close()
+
+    results = dict(zip(names, columns))
+    for metric in (rows[0] if rows else ()):
+        results[metric] = np.array([row[metric] for row in rows])
+    if path is not None:
+        save(path, results)
+    return results
+
+
+def save(path, results):
+    np.savez_compressed(path, **results)
+
+
+def load(path):
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+
+def follow_trajectory(parameters, shared, rng):
+    '''
+    Example task: follow the shared "trajectory" with Ramsete on a simulated drivetrain with noisy pose readings
+    parameters: b, zeta, track_width (what the controller thinks it is) and optionally noise (m of pose noise)
+    '''
+    from resources.Calculations.Geometry import Pose
+    from resources.Calculations.Kinematics import Ramsete
+    from resources.Calibration.pathweaver import Trajectory, State
+    from resources.Interfaces.Simulation import SimulatedDrivetrain
+
+    trajectory, period, now = Trajectory(shared["trajectory"]), 0.02, [0.0]
+    drivetrain = SimulatedDrivetrain(0.6, clock=lambda: now[0], latency=0)
+    controller = Ramsete(parameters["track_width"], parameters["b"], parameters["zeta"])
+    noise = parameters.get("noise", 0.01)
+    state, pose, squared_error, steps = State(), Pose(), 0, 0
+    while now[0] <= trajectory.total_time:
+        trajectory.sample(now[0], state)
+        true_pose = drivetrain.update()
+        pose(true_pose.x + rng.normal(0, noise), true_pose.y + rng.normal(0, noise), true_pose.theta)
+        controller.calculate(pose, state)
+        drivetrain.left.speed, drivetrain.right.speed = controller.left_speed, controller.right_speed
+        squared_error += (state.x - true_pose.x) ** 2 + (state.y - true_pose.y) ** 2
+        steps += 1
+        now[0] += period
+    return {"rms_error": (squared_error / steps) ** 0.5, "final_error": true_pose.distance(state)}
+
+
+if __name__ == "__main__":  # tune Ramsete on one and then every core
+    import tempfile, time
+    from math import pi
+    from resources.Calibration.pathweaver import TrajectoryConfig, generate_trajectory
+
+    trajectory = generate_trajectory([(0, 0, 0), (2, 1, pi / 4), (4, 1, 0)], TrajectoryConfig(1.5, 1.5, max_centripetal=1.5))
+    parameters = grid(b=[1, 2, 3, 4], zeta=[0.3, 0.5, 0.7, 0.9], track_width=[0.55, 0.6, 0.65])
+    path = os.path.join(tempfile.mkdtemp(), "ramsete.npz")
+    timings = {}
+    for workers in sorted({1, os.cpu_count() or 1}):
+        start = time.perf_counter()
+        results = sweep(follow_trajectory, parameters, {"trajectory": trajectory.data}, seed=1, workers=workers, path=path)
+        timings[workers] = time.perf_counter() - start
+    best = int(np.argmin(results["rms_error"]))
+    print(f"{len(results['b'])} runs: " + ", ".join(f"{workers} workers {elapsed:.2f}s" for workers, elapsed in timings.items()))
+    print("best:", {name: float(column[best]) for name, column in load(path).items()})
@@ -1,5 +1,143 @@
+from array import array
+from numbers import Real
+from threading import Lock, Thread
+from resources import configs
+from resources.Communications.Protocol import encode
+from resources.Structure.Scheduler import Scheduler
+
+
+def _is_number(value):
+    return isinstance(value, Real) and not isinstance(value, bool)  # numpy scalars too
+
+
+def _type_name(value):
+    t = type(value)
+    if _is_number(value): return "number"
+    if t is bool: return "boolean"
+    if t is str: return "string"
+    return "value"
+
+
 class Dashboard:
     '''
     The robot side to store and send updates of Dashboard values
+    Numbers are stored in an array, every publish sends only the values that changed in one DashboardBatch message
     '''
-    pass
+    def __init__(self, messenger, period=None):
+        self.messenger = messenger
+        self.scheduler = Scheduler(configs.dashboard_period if period is None else period, spin=0)  # timing isn't critical, don't spin
+        self.scheduler.add(self.publish)
+        self._lock = Lock()
+        self._numbers = array('d')  # numeric values by index
+        self._number_names = []
+        self._changed = bytearray()  # 1 if the number at that index changed since the last publish
+        self._changed_numbers = []  # indices of the changed numbers
+        self._indices = {}  # name -> index in _numbers
+        self._values = {}  # name -> any other type of value
+        self._changed_values = set()
+        self._created = []  # (name, type) of entries the dashboard hasn't been told about
+        messenger.on_receive("DashboardSync", self.sync)
+
+    def start(self):
+        Thread(target=self.scheduler.run, daemon=True).start()
+
+    def stop(self):
+        self.scheduler.stop()
+
+    def put(self, name, value):
+        if _is_number(value):
+            value = float(value)
+            index = self._indices.get(name)
+            if index is None:
+                index = self._create_number(name)
+            elif self._numbers[index] == value:
+                return
+            with self._lock:
+                self._numbers[index] = value
+                if not self._changed[index]:
+                    self._changed[index] = 1
+                    self._changed_numbers.append(index)
+        else:
+            if hasattr(value, "tolist"):  # numpy arrays, as lists so they can be compared and sent
+                value = value.tolist()
+            if name in self._values and self._values[name] == value:
+                return
+            with self._lock:
+                if name not in self._values:
+                    self._created.append((name, _type_name(value)))
+                self._values[name] = value
+                self._changed_values.add(name)
+
+    def get(self, name, default=None):
+        index = self._indices.get(name)
+        if index is not None:
+            return self._numbers[index]
+        return self._values.get(name, default)
+
+    def _create_number(self, name):
+        with self._lock:
+            index = len(self._numbers)
+            self._numbers.append(0)
+            self._number_names.append(name)
+            self._changed.append(0)
+            self._indices[name] = index
+            self._created.append((name, "number"))
+        return index
+
+    def publish(self):
+        '''
+        Send every entry created and every value changed since the last publish as one message
+        '''
+        with self._lock:
+            if not self._changed_numbers and not self._changed_values:
+                return
+            names, values = [], []
+            numbers, number_names, changed = self._numbers, self._number_names, self._changed
+            for index in self._changed_numbers:
+                names.append(number_names[index])
+                values.append(numbers[index])
+                changed[index] = 0
+            for name in self._changed_values:
+                names.append(name)
+                values.append(self._values[name])
+            created = self._created
+            self._changed_numbers = []
+            self._changed_values = set()
+            self._created = []
+        batch = {
+            "id": "DashboardBatch",
+            "created": [name for name, _ in created], "types": [t for _, t in created],
+            "names": names, "values": values,
+        }
+        try:
+            self.messenger.send(batch)
+        except (TypeError, ValueError):  # a value that can't be sent, drop it instead of killing the publish thread
+            batch["names"], batch["values"] = self._sendable(names, values)
+            self.messenger.send(batch)
+
+    def _sendable(self, names, values):
+        kept_names, kept_values = [], []
+        for name, value in zip(names, values):
+            try:
+                encode({"id": "msg", "value": value})
+            except (TypeError, ValueError) as e:
+                print(f"Dashboard: dropping {name}:", e)
+                with self._lock:
+                    self._values.pop(name, None)
+                continue
+            kept_names.append(name)
+            kept_values.append(value)
+        return kept_names, kept_values
+
+    def sync(self):
+        '''
+        Resend every entry and value, used when a new dashboard connects
+        '''
+        with self._lock:
+            self._created = [(name, "number") for name in self._number_names]
+            self._created += [(name, _type_name(value)) for name, value in self._values.items()]
+            for index in range(len(self._numbers)):
+                if not self._changed[index]:
+                    self._changed[index] = 1
+                    self._changed_numbers.append(index)
+            self._changed_values.update(self._values)
\ No newline at end of file
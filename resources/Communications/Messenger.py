@@ -1,5 +1,7 @@
-import socket, threading, pickle  #, jpysocket
+import asyncio, threading, time  #, jpysocket
+from collections import OrderedDict
 import constants
+from resources.Communications.Protocol import FrameReader, encode_frame
 
 
 class Messenger:
@@ -7,74 +9,224 @@ class Messenger:
     Python -> Java socket wrapper
     Protocol:
     All messages be a dictionary / HashMap with an entry being "id"
+    Each message is sent as a length prefixed frame (see Protocol.py for the encoding)
 
     Controller info:
-    -id=Controller{n} (ie Controller1) -> input name, new input value
+    -id=Controller{n} (ie Controller1) -> changed, buttons (bitmasks), axis_mask, axes (int16s), see Controller.py
     Dashboard:
     -id=DashboardCreate -> unit name, [unit type, unit location info]  # todo: check this
     -id=DashboardUpdate -> name, value
+    -id=DashboardBatch -> created, types (entries new since the last batch), names, values (every value that changed)
+    -id=DashboardSync -> (sent to the robot) resend every DashboardCreate and value
+    Timing:
+    -id=TimingRequest -> (sent to the robot) reply with a TimingReport
+    -id=TimingReport -> timings (name -> count, mean, p50, p99, max in microseconds), profile [name, self %, total %]
+    Vision:
+    -id=VisionPose -> x, y, theta and time (robot clock, when the image was taken) or latency (seconds ago), [noise]
     Serial:
     -id=msg -> "value", string message
+
+    All sockets are run by one asyncio loop on a background thread, so any number of clients
+    (driver station, dashboard viewer, logger) can connect and send/on_receive work from any thread
+    send only queues the message, the loop thread writes everything queued in one batch
     '''
-    _key = dict()
+    reconnect_delay = 0.1  # first wait before reconnecting, doubles up to max_reconnect_delay
+    max_reconnect_delay = 2
+    outbox_size = 256  # frames queued per client before the oldest are dropped
+    write_buffer_limit = 64 * 1024  # bytes the socket can buffer before a client counts as backed up
 
-    def __init__(self):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        try:
-            self.host(constants.IP, constants.PORT)
-        except Exception as e:
-            print("Connection Error:", e)
+    def __init__(self, host=True):
+        self._key = dict()
+        self._connections = set()
+        self._server = None
+        self._address = None  # where to reconnect to when this is a client
+        self.running = True
+        self.bytes_sent = 0
+        self._flush_scheduled = False
+        self._last_stats = time.monotonic(), 0
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        if host:
+            try:
+                self.host(constants.IP, constants.PORT)
+            except Exception as e:
+                print("Connection Error:", e)
+
+    @property
+    def connected(self):
+        return len(self._connections) > 0
 
     def host(self, ip, port):
-        self.socket.bind((ip, port))
-        self.socket.listen(2)  # the number is the overflow amount of sockets to connect
-        connecting_socket, address = self.socket.accept()
-        self.connected = connecting_socket
-        self.running = True
-        threading.Thread(target=self.receive).start()
+        '''
+        Start listening for clients, this doesn't wait for anyone to connect
+        '''
+        start = self.loop.create_server(lambda: _Connection(self), ip, port)
+        self._server = asyncio.run_coroutine_threadsafe(start, self.loop).result()  # raises if it can't bind
 
     def connect(self, ip, port):
-        self.socket.connect((ip, port))
-        self.connected = self.socket
+        '''
+        Connect to a hosting Messenger, reconnecting whenever the connection drops
+        '''
+        self._address = ip, port
+        asyncio.run_coroutine_threadsafe(self._connect(), self.loop)
 
-    def receive(self):
+    async def _connect(self):
+        delay = self.reconnect_delay
         while self.running:
             try:
-                raw = self.connected.recv(2048)  # wait to receive data (up to 2048 bytes at a time)
-                if len(raw) == 0: continue  # sometimes java sockets do dumb
-                msg = pickle.loads(raw)
-                id = msg["id"]  # all messages have a id
-                if id in self._key:  # if you have added a listener for this message
-                    func, include_args = self._key[id]
-                    func(msg) if include_args else func()  #  pass the data from the dict
-            except Exception as e:
-                print("Connection error:", e)
-                self.close()
-
-    def send(self, thing, **kwargs):
-        print("sending:", thing)
-        # assert "\n" not in thing, "You cant send anything with line breaks"
-        # assert "\n" not in id, "Your id cant have line breaks"
-        # print("Sending: ", (id, thing))
-        # self.connected.send(bytes(id + "\n", self.byte_type))
-        # self.connected.send(bytes(thing + "\n", self.byte_type))
-        print(kwargs)
-        raw = pickle.dumps(thing)
-        self.connected.send(raw)  # Send Msg
+                await self.loop.create_connection(lambda: _Connection(self), *self._address)
+                return
+            except OSError:
+                await asyncio.sleep(delay)
+                delay = min(2 * delay, self.max_reconnect_delay)
+
+    def _lost(self, connection):
+        self._connections.discard(connection)
+        if self.running and self._address is not None:
+            self.loop.create_task(self._connect())
+
+    def _dispatch(self, msg):
+        id = msg["id"]  # all messages have a id
+        if id in self._key:  # if you have added a listener for this message
+            func, include_args = self._key[id]
+            func(msg) if include_args else func()  #  pass the data from the dict
+
+    def send(self, thing):
+        raw = encode_frame(thing)
+        key = ("DashboardUpdate", thing["name"]) if thing["id"] == "DashboardUpdate" else None  # only the latest value matters
+        for connection in tuple(self._connections):
+            connection.outbox.put(raw, key)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.loop.call_soon_threadsafe(self._flush)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        for connection in self._connections:
+            connection.flush()
+
+    def stats(self):
+        '''
+        Link usage for every client, bytes_per_second is measured since the last call
+        '''
+        now, sent = time.monotonic(), self.bytes_sent
+        start, start_sent = self._last_stats
+        self._last_stats = now, sent
+        connections = tuple(self._connections)
+        return {
+            "clients": len(connections),
+            "queued": sum(len(connection.outbox) for connection in connections),
+            "dropped": sum(connection.outbox.dropped for connection in connections),
+            "coalesced": sum(connection.outbox.coalesced for connection in connections),
+            "bytes_sent": sent,
+            "bytes_per_second": (sent - start_sent) / (now - start) if now > start else 0,
+        }
 
     def on_receive(self, id, func, pass_data=False):
         self._key[id] = func, pass_data
 
     def close(self):
         self.running = False
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop)
+
+    async def _close(self, timeout=1):
+        if self._server is not None:
+            self._server.close()
+        for connection in list(self._connections):
+            connection.transport.close()
+        deadline = self.loop.time() + timeout
+        while self._connections and self.loop.time() < deadline:  # let connection_lost run so the sockets really close
+            await asyncio.sleep(0.005)
+        self.loop.stop()
+
+
+class _Connection(asyncio.BufferedProtocol):
+    '''
+    One socket of a Messenger, data is received straight into its FrameReader
+    '''
+    def __init__(self, messenger):
+        self.messenger = messenger
+        self.reader = FrameReader()
+        self.outbox = Outbox(messenger.outbox_size)
+        self.transport = None
+        self.paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self.messenger.write_buffer_limit)
+        self.messenger._connections.add(self)
+
+    def pause_writing(self):  # the socket is backed up, let the outbox fill (and drop) instead
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.flush()
+
+    def flush(self):
+        if self.paused or not len(self.outbox): return
+        raw = self.outbox.take()
+        self.transport.write(raw)  # every queued frame goes out in one write
+        self.messenger.bytes_sent += len(raw)
+
+    def get_buffer(self, sizehint):
+        return self.reader.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.reader.advance(nbytes)
         try:
-            self.socket.shutdown(socket.SHUT_RDWR)
-            self.socket.close()
-        except: pass
-        try:
-            self.connected.shutdown(socket.SHUT_RDWR)
-            self.connected.close()
-        except: pass
+            messages = self.reader.messages()
+        except Exception as e:  # the stream is corrupt, drop this client
+            print("Connection error:", e)
+            self.transport.close()
+            return
+        for msg in messages:
+            try:
+                self.messenger._dispatch(msg)
+            except Exception as e:
+                print("Error handling", msg["id"], e)
+
+    def connection_lost(self, exc):
+        self.messenger._lost(self)
+
+
+class Outbox:
+    '''
+    Bounded queue of frames waiting to be written
+    A frame with a key replaces the queued frame with the same key, when full the oldest frame is dropped
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.dropped = 0
+        self.coalesced = 0
+        self._frames = OrderedDict()
+        self._count = 0  # unique key for frames that can't be coalesced
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, frame, key=None):
+        with self._lock:
+            if key is None:
+                key = self._count
+                self._count += 1
+            elif key in self._frames:
+                self._frames[key] = frame
+                self.coalesced += 1
+                return
+            self._frames[key] = frame
+            if len(self._frames) > self.size:
+                self._frames.popitem(last=False)
+                self.dropped += 1
+
+    def take(self):
+        '''
+        Remove every queued frame and join them into one buffer
+        '''
+        with self._lock:
+            frames, self._frames = self._frames, OrderedDict()
+        return b''.join(frames.values())
 
 
 if __name__ == "__main__":
@@ -82,7 +234,6 @@ if __name__ == "__main__":
     message = ""
     while message != "q":
         message = input("")
-        m.send({"msg": message})
+        m.send({"id": "msg", "value": message})
     m.close()
 
-
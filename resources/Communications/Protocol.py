@@ -0,0 +1,397 @@
+import struct
+
+'''
+Wire format used by the Messenger
+Frame: 4 byte big-endian payload length, then the payload
+Payload: 1 byte message id code (see IDS), then the rest of the message dictionary as a tagged map
+
+Tagged values (1 byte tag, then the data):
+N None, T True, F False
+b int8, i int32, q int64, d float64
+s str (1 byte length), S str (4 byte length), y bytes (4 byte length)
+l list (4 byte count, then tagged values)
+m map (1 byte count, then short str key + tagged value pairs)
+
+The hottest messages use a fixed struct layout instead of the map (marked by an f where the m would be):
+Controller{n} -> changed, buttons (uint32s), axis_mask (uint16), then the packed axes to the end
+DashboardUpdate with a float value -> value (float64), then the name to the end
+DashboardBatch of only float values -> created and value counts (uint16s), the values (float64s),
+    then names, created and types joined by NULs to the end
+Anything that doesn't fit a layout (other types, extra keys, too big) is sent as a map
+'''
+
+MAX_FRAME = 1 << 24  # anything bigger than this is a corrupt stream
+
+IDS = ['msg', 'DashboardCreate', 'DashboardUpdate', 'enable', 'disable', 'auto', 'teleop', 'DashboardBatch', 'DashboardSync',
+       'TimingRequest', 'TimingReport', 'VisionPose']
+CUSTOM = 0  # followed by the id as a short str
+CONTROLLER = 0x80  # Controller{n} is sent as CONTROLLER | n
+
+_id_codes = {name: i + 1 for i, name in enumerate(IDS)}
+
+_length = struct.Struct('!I')
+_int8 = struct.Struct('!b')
+_int32 = struct.Struct('!i')
+_int64 = struct.Struct('!q')
+_float = struct.Struct('!d')
+_controller = struct.Struct('!IIH')
+_counts = struct.Struct('!HH')
+FIXED = 102  # f, replaces the map tag for a fixed layout
+
+
+def _encode_str(out, string):
+    raw = string.encode()
+    if len(raw) < 256:
+        out += b's'
+        out.append(len(raw))
+    else:
+        out += b'S'
+        out += _length.pack(len(raw))
+    out += raw
+
+
+def _encode_value(out, value):
+    t = type(value)
+    if t is float:
+        out += b'd'
+        out += _float.pack(value)
+    elif t is bool:
+        out += b'T' if value else b'F'
+    elif t is int:
+        if -128 <= value < 128:
+            out += b'b'
+            out += _int8.pack(value)
+        elif -2**31 <= value < 2**31:
+            out += b'i'
+            out += _int32.pack(value)
+        elif -2**63 <= value < 2**63:
+            out += b'q'
+            out += _int64.pack(value)
+        else:
+            raise ValueError(f"Can't send ints over 64 bits ({value})")
+    elif t is str:
+        _encode_str(out, value)
+    elif value is None:
+        out += b'N'
+    elif t is dict:
+        _encode_map(out, value)
+    elif t is list or t is tuple:
+        out += b'l'
+        out += _length.pack(len(value))
+        for item in value:
+            _encode_value(out, item)
+    elif t is bytes or t is bytearray or t is memoryview:
+        out += b'y'
+        out += _length.pack(len(value))
+        out += value
+    else:
+        raise TypeError(f"Can't send values of type {t.__name__}")
+
+
+def _encode_map(out, dictionary):
+    if len(dictionary) > 255:
+        raise ValueError("Messages can have at most 255 entries")
+    out += b'm'
+    out.append(len(dictionary))
+    for key, value in dictionary.items():
+        raw = str(key).encode()
+        out.append(len(raw))
+        out += raw
+        _encode_value(out, value)
+
+
+def _is_uint(value, bits):
+    return type(value) is int and 0 <= value < 1 << bits
+
+
+def _pack_controller(out, message):
+    mask = message.get("axis_mask", 0)
+    axes = message.get("axes", b'')
+    if (len(message) != (5 if mask else 3) or not _is_uint(message.get("changed"), 32)
+            or not _is_uint(message.get("buttons"), 32) or not _is_uint(mask, 16) or mask and type(axes) is not bytes):
+        return False
+    out.append(FIXED)
+    out += _controller.pack(message["changed"], message["buttons"], mask)
+    out += axes
+    return True
+
+
+def _unpack_controller(payload, i, message):
+    message["changed"], message["buttons"], mask = _controller.unpack_from(payload, i)
+    if mask:
+        message["axis_mask"] = mask
+        message["axes"] = bytes(payload[i + 10:])
+    return message
+
+
+def _pack_update(out, message):
+    name, value = message.get("name"), message.get("value")
+    if len(message) != 3 or type(value) is not float or type(name) is not str:
+        return False
+    out.append(FIXED)
+    out += _float.pack(value)
+    out += name.encode()
+    return True
+
+
+def _unpack_update(payload, i, message):
+    message["name"] = str(payload[i + 8:], 'utf-8')
+    message["value"] = _float.unpack_from(payload, i)[0]
+    return message
+
+
+def _pack_batch(out, message):
+    created, types, names, values = (message.get(key) for key in ("created", "types", "names", "values"))
+    if (len(message) != 5 or type(created) is not list or type(types) is not list or type(names) is not list
+            or type(values) is not list or len(created) != len(types) or len(names) != len(values)
+            or len(created) >= 1 << 16 or len(values) >= 1 << 16):
+        return False
+    strings = names + created + types
+    if not all(type(value) is float for value in values) or not all(type(string) is str and '\0' not in string for string in strings):
+        return False
+    out.append(FIXED)
+    out += _counts.pack(len(created), len(values))
+    out += struct.pack(f'!{len(values)}d', *values)
+    out += '\0'.join(strings).encode()
+    return True
+
+
+def _unpack_batch(payload, i, message):
+    created, count = _counts.unpack_from(payload, i)
+    i += 4
+    message["values"] = list(struct.unpack_from(f'!{count}d', payload, i))
+    i += 8 * count
+    strings = str(payload[i:], 'utf-8').split('\0') if count or created else []
+    message["created"], message["types"], message["names"] = strings[count:count + created], strings[count + created:], strings[:count]
+    return message
+
+
+_packers = {'DashboardUpdate': _pack_update, 'DashboardBatch': _pack_batch}
+_unpackers = {_id_codes['DashboardUpdate']: _unpack_update, _id_codes['DashboardBatch']: _unpack_batch}
+
+
+def encode(message):
+    '''
+    Encode a message dictionary into a payload (without the length prefix)
+    '''
+    out = bytearray()
+    id = message["id"]
+    code = _id_codes.get(id)
+    if code is not None:
+        out.append(code)
+        packer = _packers.get(id)
+    elif id.startswith("Controller") and id[10:].isdigit() and int(id[10:]) < 128:
+        out.append(CONTROLLER | int(id[10:]))
+        packer = _pack_controller
+    else:
+        out.append(CUSTOM)
+        raw = id.encode()
+        out.append(len(raw))
+        out += raw
+        packer = None
+    if packer is None or not packer(out, message):
+        _encode_map(out, {key: value for key, value in message.items() if key != "id"})
+    return out
+
+
+def encode_frame(message):
+    '''
+    Encode a message dictionary into a length prefixed frame ready to be written to a socket
+    '''
+    payload = encode(message)
+    return _length.pack(len(payload)) + payload
+
+
+def _decode_value(data, i):
+    tag = data[i]
+    i += 1
+    if tag == 100:  # d
+        return _float.unpack_from(data, i)[0], i + 8
+    if tag == 98:  # b
+        return _int8.unpack_from(data, i)[0], i + 1
+    if tag == 115:  # s
+        end = i + 1 + data[i]
+        return str(data[i + 1:end], 'utf-8'), end
+    if tag == 84:  # T
+        return True, i
+    if tag == 70:  # F
+        return False, i
+    if tag == 78:  # N
+        return None, i
+    if tag == 105:  # i
+        return _int32.unpack_from(data, i)[0], i + 4
+    if tag == 113:  # q
+        return _int64.unpack_from(data, i)[0], i + 8
+    if tag == 109:  # m
+        return _decode_map(data, i, {})
+    if tag == 108:  # l
+        count = _length.unpack_from(data, i)[0]
+        i += 4
+        items = []
+        for _ in range(count):
+            item, i = _decode_value(data, i)
+            items.append(item)
+        return items, i
+    if tag == 83:  # S
+        end = i + 4 + _length.unpack_from(data, i)[0]
+        return str(data[i + 4:end], 'utf-8'), end
+    if tag == 121:  # y
+        end = i + 4 + _length.unpack_from(data, i)[0]
+        return bytes(data[i + 4:end]), end
+    raise ValueError(f"Unknown tag {tag} in message")
+
+
+def _decode_map(data, i, dictionary):
+    count = data[i]
+    i += 1
+    for _ in range(count):
+        end = i + 1 + data[i]
+        key = str(data[i + 1:end], 'utf-8')
+        dictionary[key], i = _decode_value(data, end)
+    return dictionary, i
+
+
+def decode(payload):
+    '''
+    Decode a payload (bytes or memoryview, without the length prefix) into a message dictionary
+    '''
+    code = payload[0]
+    i = 1
+    if code & CONTROLLER:
+        message = {"id": "Controller" + str(code & ~CONTROLLER)}
+        if payload[i] == FIXED:
+            return _unpack_controller(payload, i + 1, message)
+    elif code == CUSTOM:
+        end = i + 1 + payload[i]
+        message = {"id": str(payload[i + 1:end], 'utf-8')}
+        i = end
+    else:
+        message = {"id": IDS[code - 1]}
+        if payload[i] == FIXED:
+            return _unpackers[code](payload, i + 1, message)
+    if payload[i] != 109:
+        raise ValueError("Message body must be a map")
+    return _decode_map(payload, i + 1, message)[0]
+
+
+class FrameReader:
+    '''
+    Reassembles frames from a stream into a reusable buffer
+    A read can hold part of a frame or several frames, every complete frame is decoded
+    '''
+    def __init__(self, size=4096):
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # first unread byte
+        self._end = 0  # end of the received data
+
+    def get_buffer(self, needed=None):
+        '''
+        The free space to receive into, compacting or growing the buffer so the next frame fits
+        '''
+        if needed is None:
+            needed = self._needed()
+        if len(self._buffer) - self._end < needed:
+            pending = self._end - self._start
+            if pending + needed > len(self._buffer):  # doesn't fit even after compacting
+                self._view.release()
+                grown = bytearray(max(2 * len(self._buffer), pending + needed))
+                grown[:pending] = self._buffer[self._start:self._end]
+                self._buffer = grown
+                self._view = memoryview(self._buffer)
+            else:
+                self._buffer[:pending] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, pending
+        return self._view[self._end:]
+
+    def advance(self, amount):
+        '''
+        Mark amount bytes of the free space as received
+        '''
+        self._end += amount
+
+    def recv_from(self, sock):
+        '''
+        Read from the socket and return every message that has been completed
+        '''
+        with self.get_buffer() as free:
+            amount = sock.recv_into(free)
+        if amount == 0:
+            raise ConnectionError("Socket closed")
+        self.advance(amount)
+        return self.messages()
+
+    def messages(self):
+        messages = []
+        start, end = self._start, self._end
+        view = self._view
+        while end - start >= 4:
+            size = _length.unpack_from(view, start)[0]
+            if size > MAX_FRAME:
+                raise ValueError(f"Frame of {size} bytes is too large")
+            if end - start - 4 < size:  # frame isn't complete yet
+                break
+            with view[start + 4:start + 4 + size] as payload:
+                messages.append(decode(payload))
+            start += 4 + size
+        if start == end:  # everything was read, start from the front again
+            start = end = 0
+        self._start, self._end = start, end
+        return messages
+
+    def _needed(self):
+        pending = self._end - self._start
+        if pending < 4:
+            return 4096
+        return max(4 + _length.unpack_from(self._view, self._start)[0] - pending, 4096)
+
+
+if __name__ == "__main__":  # benchmark against the old pickle path
+    import pickle, time
+
+    samples = [  # the hot messages (fixed layouts) and a couple that still go through the map
+        {"id": "Controller1", "changed": 0b101, "buttons": 0b1, "axis_mask": 0b11, "axes": struct.pack("!2h", 8192, -16384)},
+        {"id": "DashboardUpdate", "name": "drive/left_speed", "value": 1.2345},
+        {"id": "DashboardBatch", "created": [], "types": [], "names": ["drive/left_speed", "drive/right_speed", "arm/angle"],
+         "values": [1.25, 1.5, 0.75]},
+        {"id": "DashboardCreate", "name": "drive/left_speed", "type": "graph", "location": [2, 3]},
+        {"id": "msg", "value": "hello driver station"},
+    ]
+    for sample in samples:
+        assert decode(encode(sample)) == sample
+    n = 50000
+
+    def bench(name, dump, load, samples):
+        stream = b''.join(dump(samples[i % len(samples)]) for i in range(n))
+        start = time.perf_counter()
+        count = load(stream)
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {len(stream) / n:.1f} bytes/msg, {count / elapsed:,.0f} msgs/s, {elapsed / count * 1e6:.2f} us/msg decode")
+
+    def load_pickle(stream):  # what the old receive did, assuming one message per read
+        file, count = __import__('io').BytesIO(stream), 0
+        while file.tell() < len(stream):
+            pickle.load(file)
+            count += 1
+        return count
+
+    class Chunks:  # pretend socket that hands out 2048 byte reads
+        def __init__(self, stream):
+            self.stream, self.i = memoryview(stream), 0
+
+        def recv_into(self, buffer):
+            chunk = self.stream[self.i:self.i + min(2048, len(buffer))]
+            buffer[:len(chunk)] = chunk
+            self.i += len(chunk)
+            return len(chunk)
+
+    def load_frames(stream):
+        reader, sock, count = FrameReader(), Chunks(stream), 0
+        while sock.i < len(stream):
+            count += len(reader.recv_from(sock))
+        return count
+
+    for label, count in (("hot messages (fixed layouts)", 3), ("every message", len(samples))):
+        print(label)
+        bench("  pickle", pickle.dumps, load_pickle, samples[:count])
+        bench("  frames", encode_frame, load_frames, samples[:count])
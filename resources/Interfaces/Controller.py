@@ -1,4 +1,8 @@
-from resources.configs import main_robot
+from array import array
+from collections import deque
+import struct
+import numpy as np
+from resources import configs
 
 
 class Button:
@@ -20,15 +24,18 @@ class Button:
     def on_release(self, func):
         self._release.append(func)
 
-    def __setattr__(self, key, value):
-        if key == "value" and type(value) == bool:
-            previous = self._get()
-            toggle = value != previous
-            if toggle:
-                l = self._click if value else self._release
-                for func in l:
-                    func()
-        super(Button, self).__setattr__(key, value)
+    def set(self, value):
+        '''
+        Change a plain bool button, running the click / release listeners if it toggled
+        '''
+        previous = self._get()
+        self.value = value
+        if value != previous:
+            self._edge(value)
+
+    def _edge(self, pressed):
+        for func in self._click if pressed else self._release:
+            func()
 
     def __bool__(self):
         return self._get()
@@ -37,41 +44,183 @@ class Button:
 class Axis:
     '''
     A float wrapper that can apply control configs to allow for more sensitive controls
+    The response (dead band, expo and rates, or any curve) is compiled into a lookup table when a config changes,
+    so a read is one interpolation between table entries
     '''
+    RESOLUTION = 257  # table entries from -1 to 1 (odd so 0 is an entry)
+    _last = RESOLUTION - 1
+    _half = (RESOLUTION - 1) / 2
+    _configs = ('rate', 'expo', 'super_rate', 'dead_band', 'curve')
+
     def __init__(self, val=0.0):
         self.rate = 1
         self.expo = 0
         self.super_rate = 0
         self.dead_band = 0
+        self.curve = None  # custom response, a function of the (dead banded) input from -1 to 1, replaces expo and rates
         self.value = val
+        self.version = 0  # goes up every time the table is rebuilt
 
-    def _get(self):  # this is fancy control thing i copied from kyber
-        command = self.value() if callable(self.value) else self.value
+    def __setattr__(self, key, value):
+        if key in self._configs:
+            object.__setattr__(self, '_table', None)  # rebuilt on the next read
+        elif key == 'value':
+            object.__setattr__(self, '_getter', value if callable(value) else None)
+        object.__setattr__(self, key, value)
 
-        if command > self.dead_band:
-            command = (1 / (1 - self.dead_band)) * command - (self.dead_band / (1 - self.dead_band))
-        elif command < -self.dead_band:
-            command = (1 / (1 - self.dead_band)) * command - (self.dead_band / (1 - self.dead_band))
-        else: return 0
+    def response(self, command):
+        '''
+        The shaped output for a raw input from -1 to 1 (vectorized, this is what the table is built from)
+        '''
+        command = np.asarray(command, dtype=float)
+        dead_band = self.dead_band
+        magnitude = np.maximum(np.abs(command) - dead_band, 0) / (1 - dead_band)  # this is fancy control thing i copied from kyber
+        command = np.sign(command) * magnitude
+        if self.curve is not None:
+            return np.vectorize(self.curve, otypes=[float])(command)
         retval = (1 + 0.01 * self.expo * (command * command - 1.0)) * command
-        retval = (retval * (self.rate + (abs(retval) * self.rate * self.superRate * 0.01)))
-        return retval
+        return retval * (self.rate + (np.abs(retval) * self.rate * self.super_rate * 0.01))
+
+    @property
+    def table(self):
+        if self._table is None:
+            table = self.response(np.linspace(-1, 1, self.RESOLUTION))
+            table[self.RESOLUTION // 2] = self.response(0.0)  # exactly centered
+            object.__setattr__(self, '_table', table)
+            object.__setattr__(self, '_list', table.tolist())
+            self.version += 1
+        return self._table
+
+    def _get(self):
+        getter = self._getter
+        command = getter() if getter is not None else self.value
+        table = self._list if self._table is not None else self.table.tolist()
+        position = (command + 1) * self._half
+        if position <= 0: return table[0]
+        if position >= self._last: return table[-1]
+        i = int(position)
+        low = table[i]
+        return low + (table[i + 1] - low) * (position - i)
+
+    def shape(self, commands):
+        '''
+        _get over an array of raw inputs (ie a logged match)
+        '''
+        return np.interp(commands, np.linspace(-1, 1, self.RESOLUTION), self.table)
 
     def __float__(self):
         return self._get()
 
 
+AXIS_SCALE = 32767  # axes are sent as int16s, -1 to 1 is -32767 to 32767
+
+
 class Controller:
     '''
     Abstract class for any type of controller using Axes and Buttons
+    The driver station sends deltas (see ControllerEncoder), which the messenger thread applies straight into
+    the buttons bitmask and axes array, Buttons and Axes read those
+    Presses and releases are queued and their listeners run on the control thread at the start of the next loop tick
     '''
+    button_names = []  # bit i of the bitmask is button_names[i]
+    axis_names = []
+
     def __init__(self, number):
-        self.name = "Controller" + number
-        main_robot.messenger.on_receive(self.name, )
+        self.inputs = {}
+        self.name = "Controller" + str(number)
+        self.buttons = 0  # bitmask of the buttons held down
+        self.axes = array('d', bytes(8 * len(self.axis_names)))
+        self.received = 0  # packets applied
+        self._events = deque()  # (pressed, released) bitmasks, appended by the messenger thread and taken by the control thread
+        self._button_list = []
+        self._tables = None  # every axis' table as a list, for shaped_axes
+        self._table_versions = None
+        for bit, name in enumerate(self.button_names):
+            button = Button(lambda mask=1 << bit: bool(self.buttons & mask))
+            self._button_list.append(button)
+            setattr(self, name, button)
+        for index, name in enumerate(self.axis_names):
+            setattr(self, name, Axis(lambda index=index: self.axes[index]))
+        self._axis_list = [getattr(self, name) for name in self.axis_names]
+        configs.main_robot.messenger.on_receive(self.name, self._receive, pass_data=True)
+        configs.main_robot.add_controller(self)
+
+    def _receive(self, msg):
+        '''
+        Apply a packet, called from the messenger thread
+        changed: bitmask of buttons that changed, buttons: their new states
+        axis_mask: bitmask of axes that changed, axes: their new values as big endian int16s in order
+        Packets can also be {input name: value}
+        '''
+        previous = buttons = self.buttons
+        if "changed" in msg or "axis_mask" in msg:
+            changed = msg.get("changed", 0)
+            buttons = (buttons & ~changed) | (msg.get("buttons", 0) & changed)
+            mask = msg.get("axis_mask", 0)
+            if mask:
+                axes, values = self.axes, struct.unpack_from(f"!{bin(mask).count('1')}h", msg["axes"])
+                index = 0
+                for value in values:
+                    while not mask >> index & 1:
+                        index += 1
+                    axes[index] = value / AXIS_SCALE
+                    index += 1
+        else:
+            self._update({key: value for key, value in msg.items() if key != "id"})
+            buttons = self.buttons
+        toggled = buttons ^ previous
+        self.buttons = buttons
+        if toggled:
+            self._events.append((toggled & buttons, toggled & previous))
+        self.received += 1
 
     def _update(self, new_vals):  # passes a dictionary
-        for input in new_vals:
-            self.inputs[input].value = new_vals[input]
+        buttons = self.buttons
+        for input, value in new_vals.items():
+            if input in self.button_names:
+                bit = 1 << self.button_names.index(input)
+                buttons = buttons | bit if value else buttons & ~bit
+            elif input in self.axis_names:
+                self.axes[self.axis_names.index(input)] = value
+        self.buttons = buttons
+
+    def shaped_axes(self, out=None):
+        '''
+        Every axis read from the snapshot and shaped by its table in one call, written to out (ie an array('d')) if given
+        '''
+        axes = self._axis_list
+        versions = [axis.version if axis._table is not None else None for axis in axes]
+        if versions != self._table_versions:  # an axis changed its config, or was rebuilt since
+            self._tables = [axis.table.tolist() for axis in axes]
+            self._table_versions = [axis.version for axis in axes]
+        tables = self._tables
+        out = array('d', self.axes) if out is None else out
+        half, last = Axis._half, Axis._last
+        for index, command in enumerate(self.axes):
+            table = tables[index]
+            position = (command + 1) * half
+            if position <= 0: out[index] = table[0]
+            elif position >= last: out[index] = table[-1]
+            else:
+                i = int(position)
+                low = table[i]
+                out[index] = low + (table[i + 1] - low) * (position - i)
+        return out
+
+    def dispatch(self):
+        '''
+        Run the listeners for every press and release since the last call, the robot calls this at the start of each tick
+        '''
+        events, buttons = self._events, self._button_list
+        while events:
+            pressed, released = events.popleft()
+            for mask, state in ((released, False), (pressed, True)):
+                bit = 0
+                while mask:
+                    if mask & 1:
+                        buttons[bit]._edge(state)
+                    mask >>= 1
+                    bit += 1
 
     def __setattr__(self, key, value):
         t = type(value)
@@ -84,18 +233,90 @@ class XboxController(Controller):
     '''
     Controller that is setup with Xbox buttons and axes
     '''
-    def __init__(self, number):
-        super(XboxController, self).__init__(number)
-        buttons = ['a', 'x', 'y', 'b',
-                   'rightBumper', 'leftBumper', 'leftStickButton', 'rightStickButton',
-                   'guide', 'back', 'start'
-                   'up', 'down', 'left', 'right'
-        ]
-        axes = [
-            "leftX", "leftY", "rightX", "rightY",
-            "leftTrigger", "rightTrigger"
-        ]
-        for b in buttons:
-            self.__setattr__(b, Button())
-        for a in axes:
-            self.__setattr__(a, Axis())
\ No newline at end of file
+    button_names = ['a', 'x', 'y', 'b',
+                    'rightBumper', 'leftBumper', 'leftStickButton', 'rightStickButton',
+                    'guide', 'back', 'start',
+                    'up', 'down', 'left', 'right']
+    axis_names = ["leftX", "leftY", "rightX", "rightY",
+                  "leftTrigger", "rightTrigger"]
+
+
+class ControllerEncoder:
+    '''
+    The driver station side: turns the current button bitmask and axis values into the smallest packet with the changes
+    '''
+    def __init__(self, number, axis_count=6):
+        self.id = "Controller" + str(number)
+        self.buttons = 0
+        self.axes = [0] * axis_count  # the int16 values last sent
+
+    def delta(self, buttons, axes):
+        '''
+        Packet with what changed since the last one (None if nothing did)
+        '''
+        changed = buttons ^ self.buttons
+        axis_mask, values = 0, []
+        for index, value in enumerate(axes):
+            quantized = int(round(max(-1.0, min(1.0, value)) * AXIS_SCALE))
+            if quantized != self.axes[index]:
+                self.axes[index] = quantized
+                axis_mask |= 1 << index
+                values.append(quantized)
+        if not changed and not axis_mask:
+            return None
+        self.buttons = buttons
+        message = {"id": self.id, "changed": changed, "buttons": buttons & changed}
+        if axis_mask:
+            message["axis_mask"] = axis_mask
+            message["axes"] = struct.pack(f"!{len(values)}h", *values)
+        return message
+
+    def full(self):
+        '''
+        Packet with every input, ie when the robot (re)connects
+        '''
+        message = {"id": self.id, "changed": 0x7FFFFFFF, "buttons": self.buttons,
+                   "axis_mask": (1 << len(self.axes)) - 1}
+        message["axes"] = struct.pack(f"!{len(self.axes)}h", *self.axes)
+        return message
+
+
+if __name__ == "__main__":  # cost of reading an axis, against the old formula evaluated on every read
+    import timeit
+
+    class OldAxis:
+        def __init__(self, val=0.0):
+            self.rate, self.expo, self.super_rate, self.dead_band, self.value = 1, 30, 20, 0.05, val
+
+        def _get(self):
+            command = self.value() if callable(self.value) else self.value
+            if command > self.dead_band:
+                command = (1 / (1 - self.dead_band)) * command - (self.dead_band / (1 - self.dead_band))
+            elif command < -self.dead_band:
+                command = (1 / (1 - self.dead_band)) * command + (self.dead_band / (1 - self.dead_band))
+            else: return 0
+            retval = (1 + 0.01 * self.expo * (command * command - 1.0)) * command
+            return retval * (self.rate + (abs(retval) * self.rate * self.super_rate * 0.01))
+
+    class Robot:  # just enough for a Controller
+        class messenger:
+            on_receive = staticmethod(lambda *args, **kwargs: None)
+        add_controller = staticmethod(lambda controller: None)
+    configs.main_robot = Robot
+
+    controller = XboxController(0)
+    values = [0.3, -0.7, 0.02, 0.9, -0.15, 0.5]
+    for index, value in enumerate(values):
+        controller.axes[index] = value
+    old = [OldAxis(lambda index=index: controller.axes[index]) for index in range(6)]
+    new = [getattr(controller, name) for name in controller.axis_names]
+    for axis in new:
+        axis.expo, axis.super_rate, axis.dead_band = 30, 20, 0.05
+    error = max(abs(o._get() - n._get()) for o, n in zip(old, new))
+    n = 100000
+    old_time = timeit.timeit(lambda: [axis._get() for axis in old], number=n) / n
+    new_time = timeit.timeit(lambda: [axis._get() for axis in new], number=n) / n
+    out = array('d', bytes(48))
+    batch_time = timeit.timeit(lambda: controller.shaped_axes(out), number=n) / n
+    print(f"six axes: old {old_time * 1e6:.2f} us, table {new_time * 1e6:.2f} us, shaped_axes {batch_time * 1e6:.2f} us, "
+          f"max difference {error:.5f}")
@@ -0,0 +1,144 @@
+from array import array
+from math import radians, pi
+from threading import Thread
+import random
+from resources.Structure.Clock import now, sleep, is_virtual
+from resources.Structure.Scheduler import Scheduler
+
+
+class GyroBackend:
+    '''
+    Abstract source of yaw rate readings in radians per second (counter clockwise is positive)
+    '''
+    def read_rate(self):  # override this
+        pass
+
+
+class MPU6050(GyroBackend):
+    '''
+    MPU-6050 (or MPU-9250) IMU over I2C, ie on the raspberry pi's pins 3 and 5
+    '''
+    PWR_MGMT_1 = 0x6B
+    GYRO_CONFIG = 0x1B
+    GYRO_ZOUT_H = 0x47
+    LSB_PER_DEG = 131  # at the +-250 deg/s range
+
+    def __init__(self, bus=1, address=0x68):
+        import smbus2  # only needed on the robot
+        self.bus = smbus2.SMBus(bus)
+        self.address = address
+        self.bus.write_byte_data(address, self.PWR_MGMT_1, 0)  # wake up
+        self.bus.write_byte_data(address, self.GYRO_CONFIG, 0)  # +-250 deg/s
+
+    def read_rate(self):
+        high, low = self.bus.read_i2c_block_data(self.address, self.GYRO_ZOUT_H, 2)
+        raw = (high << 8) | low
+        if raw >= 0x8000: raw -= 0x10000
+        return radians(raw / self.LSB_PER_DEG)
+
+
+class SimulatedGyro(GyroBackend):
+    '''
+    Fake gyro for testing, reports rate plus a constant bias and gaussian noise
+    '''
+    def __init__(self, rate=0, bias=0, noise=0, seed=0):
+        self.rate = rate
+        self.bias = bias
+        self.noise = noise
+        self._random = random.Random(seed)
+
+    def read_rate(self):
+        rate = self.rate() if callable(self.rate) else self.rate
+        return rate + self.bias + (self._random.gauss(0, self.noise) if self.noise else 0)
+
+
+class Gyro:
+    '''
+    Wrapper class for a gyroscope
+    Samples the backend on a background thread, removes its bias and integrates the rate into a heading
+    The newest samples are kept in a ring buffer that is only written by the sampling thread, so reads never wait
+    '''
+    def __init__(self, backend, rate=500, buffer_size=256, calibration_time=1, filter=0.2, still_rate=0.02, bias_filter=0.001):
+        self.backend = backend
+        self.period = 1 / rate
+        self.calibration_time = calibration_time  # seconds to average the bias for before integrating
+        self.filter = filter  # how much of each new reading goes into the filtered rate (1 is no filtering)
+        self.still_rate = still_rate  # rad/s, below this the robot is assumed still and the bias keeps being learned
+        self.bias_filter = bias_filter
+        self.bias = 0
+        self.samples = 0  # total samples taken, the newest is at (samples - 1) % buffer_size
+
+        self._size = buffer_size
+        self._times = array('d', bytes(8 * buffer_size))
+        self._headings = array('d', bytes(8 * buffer_size))
+        self._rates = array('d', bytes(8 * buffer_size))
+        self._heading = 0
+        self._rate = 0
+        self._previous_time = None
+        self._offset = 0  # added to the integrated heading by reset
+
+        self.scheduler = Scheduler(self.period, spin=0)  # dt is measured, so jitter doesn't matter
+        self.scheduler.add(self._sample)
+
+    def start(self):
+        self.calibrate()
+        Thread(target=self.scheduler.run, daemon=True).start()
+
+    def stop(self):
+        self.scheduler.stop()
+
+    def calibrate(self):
+        '''
+        Average calibration_time worth of samples (at the sample rate) while the robot is still to find the bias
+        On a virtual clock the samples are taken back to back, nothing would advance the clock while this waited
+        '''
+        readings, virtual = [], is_virtual()
+        for _ in range(int(self.calibration_time / self.period)):
+            readings.append(self.backend.read_rate())
+            if not virtual:
+                sleep(self.period)
+        self.bias = sum(readings) / len(readings) if readings else 0
+
+    def _sample(self):
+        time = now()
+        raw = self.backend.read_rate() - self.bias
+        rate = self._rate + self.filter * (raw - self._rate)
+        if abs(rate) < self.still_rate:  # still, slowly learn the bias drift
+            self.bias += self.bias_filter * raw
+        if self._previous_time is not None:
+            self._heading += 0.5 * (rate + self._rate) * (time - self._previous_time)  # trapezoid rule
+        self._previous_time = time
+        self._rate = rate
+
+        i = self.samples % self._size
+        self._times[i] = time
+        self._headings[i] = self._heading
+        self._rates[i] = rate
+        self.samples += 1  # publish the sample after it is fully written
+
+    def reset(self, heading=0):
+        self._offset = heading - self._heading
+
+    @property
+    def heading(self):
+        '''
+        Newest heading in radians, wrapped to [0, 2pi)
+        '''
+        return (self._heading + self._offset) % (2 * pi)
+
+    @property
+    def rate(self):
+        '''
+        Newest filtered yaw rate in radians per second
+        '''
+        return self._rate
+
+    def latest(self):
+        '''
+        The newest (time, heading, rate) sample
+        '''
+        count = self.samples
+        if count == 0:
+            return None
+        i = (count - 1) % self._size
+        return self._times[i], (self._headings[i] + self._offset) % (2 * pi), self._rates[i]
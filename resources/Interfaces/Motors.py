@@ -1,23 +1,185 @@
-import odrive
-from odrive.enums import *
+from array import array
+from importlib import import_module
+from threading import Thread, Lock, Event
+from resources import configs
 import constants, time
 
 
 driver = None
+io = None  # the ODriveIO for driver
+enums = None  # odrive.enums, odrive is only imported once an ODrive is made since it is slow and needs the hardware
 
 
 def connect_to_motors():
-    global driver
+    global driver, io, enums
+    import odrive
+    from odrive import enums
     if constants.O_DRIVE_SERIAL is None:
         driver = odrive.find_any(timeout=60)
     else:  # todo: check these configs
         driver = odrive.find_any(path='usb', serial_number=constants.O_DRIVE_SERIAL, search_cancellation_token=None, channel_termination_token=None, timeout=60)
+    io = ODriveIO(driver)
+    io.start()
+    if configs.main_robot is not None:  # send the setpoints from each loop tick once it is done
+        configs.main_robot.loop_scheduler.add(io.flush)
+
+
+class ODriveIO:
+    '''
+    Does all the usb traffic with an odrive on a background thread so the control loop never waits on it
+    Each cycle it sends the setpoints flushed since the last cycle, then reads every axis' position and velocity into a snapshot
+    Setpoints are only sent when they change, and each snapshot field keeps the time it was read so stale values can be spotted
+    Without a robot loop to flush, call flush yourself after setting everything for a tick
+    Anything else that has to touch the device (ie calibration) goes through call, which runs it on the io thread
+    '''
+    POSITION, VELOCITY = range(2)
+    FIELDS = ('pos_estimate', 'vel_estimate')
+
+    def __init__(self, device, axes=(0, 1), rate=500):
+        self.device = device
+        self.period = 1 / rate
+        self.axes = {i: getattr(device, f"axis{i}") for i in axes}
+        size = len(self.FIELDS) * (max(axes) + 1)
+        self._values = array('d', bytes(8 * size))  # [axis * len(FIELDS) + field]
+        self._times = array('d', bytes(8 * size))
+        self.running = False
+        self.cycles = 0
+        self.writes = 0  # setpoints actually sent
+        self.skipped = 0  # setpoints not sent because they hadn't changed
+        self.last_duration = 0
+
+        self._pending = {}  # (axis, path): value, set by the control loop since the last flush
+        self._flushed = {}  # the newest value flushed for every (axis, path), to compare new writes against
+        self._pending_lock = Lock()  # write and flush can be called from the loop and subsystem threads
+        self._ready = {}  # flushed but not sent yet, handed to the io thread under the lock
+        self._calls = []  # (func, done, result) for call, run by the io thread after the writes
+        self._lock = Lock()
+        self._wake = Event()
+
+    def start(self):
+        if self.running: return
+        self.running = True
+        Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        self._wake.set()
+
+    def write(self, axis, path, value, force=False):
+        '''
+        Queue axis.<path> = value (ie path="controller.vel_setpoint") for the next flush, unless it is already that
+        force sends it even if it is, for fields the odrive changes itself (ie requested_state)
+        '''
+        key = (axis, path)
+        with self._pending_lock:
+            if not force and key in self._flushed and self._flushed[key] == value:
+                if self._pending.pop(key, None) is None:
+                    self.skipped += 1
+            else:
+                self._pending[key] = value
+
+    def flush(self):
+        '''
+        Hand this tick's setpoints to the io thread and wake it, called once per loop tick
+        '''
+        if not self._pending: return
+        with self._pending_lock:  # held while handing off too, so two flushes can't hand over out of order
+            pending, self._pending = self._pending, {}
+            self._flushed.update(pending)
+            with self._lock:
+                self._ready.update(pending)
+        self._wake.set()
+
+    def call(self, func, timeout=5):
+        '''
+        Run func() on the io thread (after everything flushed before it is sent) and wait for its result
+        '''
+        done, result = Event(), []
+        with self._lock:
+            self._calls.append((func, done, result))
+        self._wake.set()
+        if not done.wait(timeout):
+            raise TimeoutError("the odrive io thread didn't run the call")
+        value, error = result
+        if error is not None:
+            raise error
+        return value
+
+    def read(self, axis, path):
+        '''
+        Read axis.<path> from the device on the io thread, waiting for it (slow, not for the control loop)
+        '''
+        return self.call(lambda: getattr(*self._target(axis, path)))
+
+    def sync(self, timeout=5):
+        '''
+        Wait until everything flushed so far has been sent
+        '''
+        self.call(lambda: None, timeout)
+
+    def _target(self, axis, path):
+        *parents, name = path.split('.')
+        target = self.axes[axis]
+        for parent in parents:
+            target = getattr(target, parent)
+        return target, name
+
+    def _run(self):
+        while self.running:
+            self._wake.wait(self.period)
+            self._wake.clear()
+            start = time.perf_counter()
+            self._cycle()
+            self.last_duration = time.perf_counter() - start
+
+    def _cycle(self):
+        if self._ready or self._calls:
+            with self._lock:
+                ready, self._ready = self._ready, {}
+                calls, self._calls = self._calls, []
+            for (axis, path), value in ready.items():
+                target, name = self._target(axis, path)
+                setattr(target, name, value)
+                self.writes += 1
+            for func, done, result in calls:
+                try:
+                    result[:] = func(), None
+                except Exception as e:
+                    result[:] = None, e
+                done.set()
+
+        values, times, count = self._values, self._times, len(self.FIELDS)
+        for i, axis in self.axes.items():
+            encoder = axis.encoder
+            for field, name in enumerate(self.FIELDS):
+                index = i * count + field
+                values[index] = getattr(encoder, name)
+                times[index] = time.perf_counter()
+        self.cycles += 1
+
+    def get(self, axis, field):
+        return self._values[axis * len(self.FIELDS) + field]
+
+    def position(self, axis):
+        return self._values[axis * len(self.FIELDS) + self.POSITION]
+
+    def velocity(self, axis):
+        return self._values[axis * len(self.FIELDS) + self.VELOCITY]
+
+    def age(self, axis, field=VELOCITY):
+        '''
+        Seconds since the field was read (infinite if it never has been)
+        '''
+        read = self._times[axis * len(self.FIELDS) + field]
+        return time.perf_counter() - read if read else float('inf')
 
 
 class MotorController:  # abstract base class
     '''
     Abstract base motor controller class
     '''
+    _voltage = 0
+
     @property
     def speed(self):  # override this
         pass
@@ -29,6 +191,25 @@ class MotorController:  # abstract base class
     def _set_speed(self, vel):
         pass
 
+    @property
+    def position(self):  # override this
+        pass
+
+    @property
+    def voltage(self):  # the last voltage commanded
+        return self._voltage
+
+    @voltage.setter
+    def voltage(self, volts):
+        self._voltage = volts
+        self._set_voltage(volts)
+
+    def _set_voltage(self, volts):  # open loop output, used for characterization
+        pass
+
+    def flush(self):  # send any queued outputs, the robot loop does this every tick
+        pass
+
 
 class ODrive(MotorController):
     '''
@@ -39,31 +220,37 @@ class ODrive(MotorController):
             connect_to_motors()
         self.motors = [driver.__getattribute__(f"axis{i}") for i in axes]
         self.indices = axes
-        self.engage()
         self._input = None
         self._control = None
+        self.engage()
 
     def disconnect(self):
         driver.release()
 
+    # calibrate and engage go through io too, so only its thread ever talks to the odrive
     def calibrate(self):  # this should never be called during normal play
-        for i, axis in enumerate(self.motors):
-            axis.requested_state = AXIS_STATE_FULL_CALIBRATION_SEQUENCE
+        for i in self.indices:
+            io.write(i, 'requested_state', enums.AXIS_STATE_FULL_CALIBRATION_SEQUENCE, force=True)
+            io.flush()
+            io.sync()
 
-            while axis.current_state != AXIS_STATE_IDLE:  # carry out the sequence until done
+            while io.read(i, 'current_state') != enums.AXIS_STATE_IDLE:  # carry out the sequence until done
                 time.sleep(0.1)
 
             # axis.motor.config.pre_calibrated = True  # todo: this might be true
             # axis.encoder.config.pre_calibrated = True
-            if axis.error != 0:
+            if io.read(i, 'error') != 0:
                 return False
         return True
 
     def engage(self):
-        for axis in self.motors:
-            axis.controller.vel_setpoint = 0
-            axis.requested_state = AXIS_STATE_CLOSED_LOOP_CONTROL
-            axis.controller.config.control_mode = CONTROL_MODE_VELOCITY_CONTROL
+        for i in self.indices:
+            io.write(i, 'controller.vel_setpoint', 0)
+            io.write(i, 'requested_state', enums.AXIS_STATE_CLOSED_LOOP_CONTROL, force=True)
+            io.write(i, 'controller.config.control_mode', enums.CONTROL_MODE_VELOCITY_CONTROL)
+        self._control = enums.CONTROL_MODE_VELOCITY_CONTROL
+        io.flush()
+        io.sync()
 
     def apply_pid(self, p, i=0, d=0):  # odrive comes with its own control loop
         pass
@@ -71,56 +258,114 @@ class ODrive(MotorController):
     def apply_feedforward(self, feedforward):  # todo: figure out how to do this
         pass
 
-    def speed(self, index=None):
-        num_motors = len(self.motors)
-        if num_motors == 1:
-            return self.motors[0].encoder.vel_estimate
+    @MotorController.speed.getter
+    def speed(self):
+        return self.get_speed()
+
+    # reads come from io's snapshot, not the odrive
+    def get_speed(self, index=None):
+        if len(self.indices) == 1:
+            return io.velocity(self.indices[0])
         elif index is None:
-            return [axis.encoder.vel_estimate for axis in self.motors]
+            return [io.velocity(i) for i in self.indices]
         else:
-            return self.motors[index].encoder.vel_estimate
+            return io.velocity(self.indices[index])
+
+    @property
+    def position(self):
+        if len(self.indices) == 1:
+            return io.position(self.indices[0])
+        return [io.position(i) for i in self.indices]
+
+    @property
+    def age(self):
+        '''
+        Seconds since the oldest of this controller's velocities was read
+        '''
+        return max(io.age(i) for i in self.indices)
+
+    # writes are queued on io and sent when it is flushed
+    def flush(self):
+        io.flush()
 
     def _set_speed(self, vel):
-        self._assert_input_mode(INPUT_MODE_VEL_RAMP)
-        self._assert_control_mode(CONTROL_MODE_VELOCITY_CONTROL)
-        for axis in self.motors:
-            axis.controller.vel_setpoint = vel
+        self._assert_input_mode(enums.INPUT_MODE_VEL_RAMP)
+        self._assert_control_mode(enums.CONTROL_MODE_VELOCITY_CONTROL)
+        for i in self.indices:
+            io.write(i, 'controller.vel_setpoint', vel)
+
+    def _set_voltage(self, volts):
+        # odrives can't command a voltage on high current motors, so this goes out as a torque command
+        # gains fit from it (see characterization.py) are then in Nm, which is what apply_feedforward sends anyway
+        self._assert_input_mode(enums.INPUT_MODE_PASSTHROUGH)
+        self._assert_control_mode(enums.CONTROL_MODE_TORQUE_CONTROL)
+        for i in self.indices:
+            io.write(i, 'controller.input_torque', volts)
 
     def _assert_control_mode(self, mode: int):
         if self._control != mode:
             self._control = mode
-            for axis in self.motors:
-                axis.controller.config.control_mode = mode
+            for i in self.indices:
+                io.write(i, 'controller.config.control_mode', mode)
 
     def _assert_input_mode(self, mode: int):
         if self._input != mode:
             self._input = mode
-            for axis in self.motors:
-                axis.controller.config.input_mode = mode
+            for i in self.indices:
+                io.write(i, 'controller.config.input_mode', mode)
 
     def mirror(self, other: MotorController, ratio=1):
-        self._assert_control_mode(CONTROL_MODE_POSITION_CONTROL)
-        self._assert_input_mode(INPUT_MODE_MIRROR)
-        axis_number = other.motors.indices[0]
-        for axis in self.motors:
-            axis.controller.config.mirror_ratio = ratio
-            axis.controller.config.axis_to_mirror = axis_number
+        self._assert_control_mode(enums.CONTROL_MODE_POSITION_CONTROL)
+        self._assert_input_mode(enums.INPUT_MODE_MIRROR)
+        axis_number = other.indices[0]
+        for i in self.indices:
+            io.write(i, 'controller.config.mirror_ratio', ratio)
+            io.write(i, 'controller.config.axis_to_mirror', axis_number)
 
 
 class Encoder:
     '''
-    Wrapper for an ODrive encoder
+    Wrapper for an ODrive encoder, reads from the io snapshot
     '''
     def __init__(self, axis_number):
-        self._inner = driver.__get_attr__(f'axis{axis_number}').encoder
+        if driver is None:
+            connect_to_motors()
+        self.axis = axis_number
 
     @property
     def position(self):
-        return self._inner.pos_estimate
+        return io.position(self.axis)
 
     @property
     def velocity(self):
-        return self._inner.vel_estimate
+        return io.velocity(self.axis)
+
+    @property
+    def age(self):
+        return io.age(self.axis)
+
+
+
+backends = {  # name: class or "module:class", imported when first used
+    "odrive": ODrive,
+    "sim": "resources.Interfaces.Simulation:SimulatedMotor",
+}
+
+
+def register_backend(name, backend):
+    backends[name] = backend
+
+
+def create_motor(*axes, backend=None, **kwargs):
+    '''
+    Make a motor controller with the named backend (configs.motor_backend by default), ie create_motor(0, backend="sim")
+    '''
+    name = configs.motor_backend if backend is None else backend
+    cls = backends[name]
+    if isinstance(cls, str):
+        module, _, attribute = cls.partition(':')
+        cls = backends[name] = getattr(import_module(module), attribute)
+    return cls(*axes, **kwargs)
 
 
 
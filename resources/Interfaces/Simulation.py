@@ -0,0 +1,166 @@
+from collections import deque
+from math import exp, floor, log
+import time
+from resources.Structure.Clock import now
+from resources.Calculations.Geometry import Pose, Twist
+from resources.Calculations.Kinematics import Feedforward
+from resources.Interfaces.Motors import MotorController
+
+'''
+Simulated motors so the robot code runs without an odrive (select it with configs.motor_backend = "sim")
+The motor is the model the Feedforward fits: voltage = ks * sign(velocity) + kv * velocity + ka * acceleration
+It is solved exactly between updates, so time can jump ahead as fast as the clock says without going unstable
+'''
+
+
+class SimulatedMotor(MotorController):
+    '''
+    A DC motor (or a side of a drivetrain) in units of whatever the feedforward was fit in, ie meters
+    Velocity setpoints are held by a feedforward plus proportional loop like the odrive's, voltages are applied directly
+    Readings are delayed by latency and the position is rounded to whole encoder counts
+    '''
+    def __init__(self, *axes, feedforward=None, velocity_gain=4, max_voltage=12, counts_per_unit=8192, latency=0.002,
+                 max_step=0.001, clock=now):
+        self.indices = axes
+        self.feedforward = Feedforward(0.5, 2, 0.3) if feedforward is None else feedforward
+        self.velocity_gain = velocity_gain  # volts per unit/s of velocity error
+        self.max_voltage = max_voltage
+        self.counts_per_unit = counts_per_unit
+        self.latency = latency
+        self.max_step = max_step  # longest piece an update is solved in, also the resolution of the latency
+        self.clock = clock
+
+        self.true_position = 0
+        self.true_velocity = 0
+        self.setpoint = None  # velocity setpoint, None when driving a voltage
+        self.applied_voltage = 0
+        self._time = clock()
+        self._history = deque([(self._time, 0.0, 0.0)])  # (time, position, velocity), back to latency ago
+
+    def update(self, now=None):
+        '''
+        Move the simulation forward to now (the clock by default)
+        '''
+        now = self.clock() if now is None else now
+        while self._time < now:
+            dt = min(self.max_step, now - self._time)
+            self._step(dt)
+            self._time += dt
+            self._history.append((self._time, self.true_position, self.true_velocity))
+        history, seen = self._history, now - self.latency
+        while len(history) > 2 and history[1][0] <= seen:
+            history.popleft()
+
+    def _step(self, dt):
+        ks, kv, ka = self.feedforward.ks, self.feedforward.kv, self.feedforward.ka
+        velocity, max_voltage = self.true_velocity, self.max_voltage
+        gain = 0
+        if self.setpoint is None:
+            constant = self.applied_voltage
+        else:  # voltage = constant - gain * velocity while it isn't saturated
+            constant = self.feedforward.estimate(self.setpoint) + self.velocity_gain * self.setpoint
+            voltage = constant - self.velocity_gain * velocity
+            if abs(voltage) > max_voltage:
+                constant = max_voltage if voltage > 0 else -max_voltage
+            else:
+                gain = self.velocity_gain
+            self.applied_voltage = constant - gain * velocity
+        damping = kv + gain
+
+        while dt > 0:
+            if velocity == 0:  # static friction holds it until the voltage beats ks
+                if abs(constant) <= ks:
+                    break
+                direction = 1 if constant > 0 else -1
+            else:
+                direction = 1 if velocity > 0 else -1
+            final = (constant - ks * direction) / damping  # the velocity it settles at
+            if ka <= 0:  # no inertia, it is there instantly
+                velocity = final
+                self.true_position += velocity * dt
+                break
+            rate = damping / ka
+            stopping = final * direction < 0
+            step = min(dt, log((velocity - final) / -final) / rate) if stopping else dt  # friction flips at the stop
+            decay = exp(-rate * step)
+            self.true_position += final * step + (velocity - final) * (1 - decay) / rate
+            velocity = 0 if stopping and step < dt else final + (velocity - final) * decay
+            dt -= step
+        self.true_velocity = velocity
+
+    def _reading(self):
+        '''
+        (position, velocity) latency ago, interpolated between updates
+        '''
+        self.update()
+        history, seen = self._history, self._time - self.latency
+        (t0, p0, v0) = history[0]
+        if len(history) == 1 or seen <= t0:
+            return p0, v0
+        t1, p1, v1 = history[1]
+        fraction = min(1, (seen - t0) / (t1 - t0))
+        return p0 + (p1 - p0) * fraction, v0 + (v1 - v0) * fraction
+
+    @MotorController.speed.getter
+    def speed(self):
+        return self._reading()[1]
+
+    @property
+    def position(self):
+        counts = self.counts_per_unit
+        return floor(self._reading()[0] * counts) / counts  # whole counts crossed, the same step size both ways
+
+    def _set_speed(self, vel):
+        self.update()
+        self.setpoint = vel
+
+    def _set_voltage(self, volts):
+        self.update()
+        self.setpoint = None
+        self.applied_voltage = max(-self.max_voltage, min(self.max_voltage, volts))
+
+
+class SimulatedDrivetrain:
+    '''
+    Two simulated sides and where they have actually driven the robot
+    For a gyro, use SimulatedGyro(rate=lambda: drivetrain.turn_rate)
+    '''
+    def __init__(self, track_width, pose=(0, 0, 0), clock=now, **kwargs):
+        self.track_width = track_width
+        self.clock = clock
+        self.left = SimulatedMotor(0, clock=clock, **kwargs)
+        self.right = SimulatedMotor(1, clock=clock, **kwargs)
+        self.true_pose = Pose(*pose)
+        self._twist = Twist()
+        self._left_position = self._right_position = 0
+
+    def update(self, now=None):
+        now = self.clock() if now is None else now
+        left, right = self.left, self.right
+        while left._time < now:  # in max_step pieces so the turns are followed closely
+            step = min(now, left._time + left.max_step)
+            left.update(step)
+            right.update(step)
+            delta_left, delta_right = left.true_position - self._left_position, right.true_position - self._right_position
+            self._left_position, self._right_position = left.true_position, right.true_position
+            self.true_pose.exp(self._twist((delta_left + delta_right) / 2, 0, (delta_right - delta_left) / self.track_width))
+        return self.true_pose
+
+    @property
+    def turn_rate(self):
+        self.update()
+        return (self.right.true_velocity - self.left.true_velocity) / self.track_width
+
+
+if __name__ == "__main__":  # a simulated second, and how much faster than real time it runs
+    steps, period = 50, 0.02
+    clock = [0.0]
+    drivetrain = SimulatedDrivetrain(0.6, clock=lambda: clock[0])
+    start = time.perf_counter()
+    for tick in range(steps):
+        drivetrain.left.speed, drivetrain.right.speed = 1.0, 1.5
+        clock[0] += period
+        drivetrain.update()
+    elapsed = time.perf_counter() - start
+    print(f"pose after 1s: {drivetrain.true_pose}, speeds {drivetrain.left.speed:.3f} {drivetrain.right.speed:.3f}")
+    print(f"{steps * period / elapsed:.0f}x real time")
@@ -0,0 +1,58 @@
+from threading import Condition
+import time
+from resources import configs
+
+
+def now():
+    '''
+    The robot's time in seconds, from configs.clock (the real clock unless a simulator swapped in a VirtualClock)
+    '''
+    return configs.clock()
+
+
+def sleep(seconds, timeout=5):
+    '''
+    Wait seconds of robot time, on a VirtualClock that means until something else advances it that far
+    Raises TimeoutError if a virtual clock isn't advanced within timeout real seconds (ie nothing is driving it)
+    '''
+    clock = configs.clock
+    if is_virtual():
+        if not clock.wait_until(clock() + seconds, timeout):
+            raise TimeoutError(f"the virtual clock wasn't advanced {seconds}s within {timeout} real seconds")
+    else:
+        time.sleep(seconds)
+
+
+def is_virtual():
+    '''
+    Whether configs.clock only moves when a simulator advances it
+    '''
+    return hasattr(configs.clock, "wait_until")
+
+
+class VirtualClock:
+    '''
+    A clock that only moves when it is advanced, so a simulated match runs as fast as the cpu allows
+    Schedulers running on their own threads wait on it instead of sleeping
+    '''
+    def __init__(self, start=0.0):
+        self.time = start
+        self._condition = Condition()
+
+    def __call__(self):
+        return self.time
+
+    def set(self, time):
+        with self._condition:
+            self.time = time
+            self._condition.notify_all()
+
+    def advance(self, seconds):
+        self.set(self.time + seconds)
+
+    def wait_until(self, deadline, timeout=None):
+        '''
+        Block until the clock reaches deadline (or timeout real seconds pass), returns whether it did
+        '''
+        with self._condition:
+            return self._condition.wait_for(lambda: self.time >= deadline, timeout)
@@ -0,0 +1,257 @@
+from array import array
+from collections import Counter
+from threading import Thread, get_ident
+import sys, time
+from resources.Structure.Clock import now
+
+'''
+Where the loop time goes: a duration histogram for every robot and subsystem callback, loop jitter and overruns
+Enabling swaps the callbacks for timed wrappers and disabling puts the originals back, so it costs nothing when off
+'''
+
+
+class Histogram:
+    '''
+    Fixed memory log-linear histogram of microseconds (like HdrHistogram)
+    Values under 2^precision are exact, above that each power of two is split into 2^(precision - 1) buckets
+    '''
+    def __init__(self, precision=5, max_value=10_000_000):
+        self.precision = precision
+        self._half = 1 << (precision - 1)
+        self.max_value = max_value
+        self.counts = array('q', bytes(8 * self._index(max_value) + 8))
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def _index(self, value):
+        shift = value.bit_length() - self.precision
+        if shift <= 0:
+            return value
+        return shift * self._half + (value >> shift)
+
+    def _lowest(self, index):
+        '''
+        Smallest value in the bucket at index
+        '''
+        if index < 2 * self._half:
+            return index
+        shift = index // self._half - 1
+        return (index - shift * self._half) << shift
+
+    def record(self, seconds):
+        value = int(seconds * 1e6)
+        if value > self.max_value: value = self.max_value
+        elif value < 0: value = 0
+        self.counts[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max: self.max = value
+
+    def percentile(self, percent):
+        '''
+        Microseconds that percent of the recorded values are at or under (to the bucket's resolution)
+        '''
+        if not self.count: return 0
+        target, seen = percent / 100 * self.count, 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return self._lowest(index)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def summary(self):
+        return {"count": self.count, "mean": self.mean, "p50": self.percentile(50), "p99": self.percentile(99), "max": self.max}
+
+    def reset(self):
+        self.counts = array('q', bytes(8 * len(self.counts)))
+        self.count = self.total = self.max = 0
+
+
+class Profiler:
+    '''
+    Opt in sampling profiler: a thread that periodically looks at what the control thread is running
+    Counts the function it is in (self) and every function on the stack (total)
+    '''
+    def __init__(self, thread_id=None, interval=0.005):
+        self.thread_id = get_ident() if thread_id is None else thread_id
+        self.interval = interval
+        self.running = False
+        self.samples = 0
+        self.self_counts = Counter()
+        self.total_counts = Counter()
+
+    def start(self):
+        self.running = True
+        Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def _run(self):
+        while self.running:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None: continue
+            self.samples += 1
+            self.self_counts[self._name(frame)] += 1
+            seen = set()
+            while frame is not None:
+                seen.add(self._name(frame))
+                frame = frame.f_back
+            self.total_counts.update(seen)
+
+    @staticmethod
+    def _name(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})"
+
+    def top(self, n=10):
+        '''
+        The n functions seen most often, as (name, percent of samples in it, percent in it or what it called)
+        '''
+        samples = self.samples or 1
+        return [(name, 100 * self.self_counts[name] / samples, 100 * total / samples)
+                for name, total in self.total_counts.most_common(n)]
+
+
+class Instrumentation:
+    '''
+    Times a robot's callbacks while enabled: robot_periodic / auto_periodic / telop_periodic, each subsystem's periodic
+    (every instance separately), the jitter of each scheduler (how late its ticks start, in microseconds) and its overruns
+    '''
+    def __init__(self, robot, publish_divisor=25):
+        self.robot = robot
+        self.publish_divisor = publish_divisor  # publish every n dashboard publishes
+        self.enabled = False
+        self.histograms = {}
+        self.profiler = None
+        self._schedulers = {"loop": robot.loop_scheduler, "subsystems": robot.subsystem_scheduler}
+        self._restore = []  # undo functions for everything enable swapped
+        robot.messenger.on_receive("TimingRequest", self._send_report)
+
+    def _timed(self, name, func):
+        histogram = self.histograms.setdefault(name, Histogram())
+        record, clock = histogram.record, time.perf_counter  # real time even in a simulation, it is the cpu being measured
+
+        def timed():
+            start = clock()
+            func()
+            record(clock() - start)
+        return timed
+
+    def _jitter(self, name, scheduler, func):
+        histogram = self.histograms.setdefault(name + "/jitter", Histogram())
+        record, period, previous = histogram.record, scheduler.period, [None]  # on the scheduler's clock
+
+        def timed():  # the first task of a scheduler, records how far apart its ticks start
+            start = now()
+            if previous[0] is not None:
+                record(abs(start - previous[0] - period))
+            previous[0] = start
+            func()
+        return timed
+
+    def enable(self):
+        if self.enabled: return
+        self.enabled = True
+        robot = self.robot
+        for method in ("robot_periodic", "auto_periodic", "telop_periodic"):
+            setattr(robot, method, self._timed(method, getattr(robot, method)))
+            self._restore.append(lambda method=method: delattr(robot, method))
+        for subsystem, name in zip(robot._subsystems, self._subsystem_names()):
+            original = subsystem.periodic
+            timed = self._timed(name, original)
+            robot.subsystem_scheduler.replace(original, timed)
+            self._restore.append(lambda original=original, timed=timed: robot.subsystem_scheduler.replace(timed, original))
+        for name, scheduler in self._schedulers.items():
+            if scheduler._tasks:
+                original = scheduler._tasks[0][0]
+                timed = self._jitter(name, scheduler, original)
+                scheduler.replace(original, timed)
+                self._restore.append(lambda scheduler=scheduler, original=original, timed=timed: scheduler.replace(timed, original))
+        robot.dashboard.scheduler.add(self.publish, self.publish_divisor)
+        self._restore.append(lambda: robot.dashboard.scheduler.remove(self.publish))
+
+    def _subsystem_names(self):
+        '''
+        A histogram name per subsystem: its name attribute or class name, numbered (Module#0, Module#1) if shared
+        '''
+        names = [getattr(subsystem, "name", None) or type(subsystem).__name__ for subsystem in self.robot._subsystems]
+        counts, seen = Counter(names), Counter()
+        numbered = []
+        for name in names:
+            if counts[name] > 1:
+                numbered.append(f"{name}#{seen[name]}")
+                seen[name] += 1
+            else:
+                numbered.append(name)
+        return numbered
+
+    def disable(self):
+        if not self.enabled: return
+        self.enabled = False
+        for restore in reversed(self._restore):
+            restore()
+        self._restore = []
+        self.stop_profiler()
+
+    def start_profiler(self, interval=0.005, thread_id=None):
+        '''
+        Sample the control thread's stack: the robot's loop thread by default
+        A simulated robot has no loop thread (the simulator ticks it), then it is the thread this is called from
+        '''
+        self.stop_profiler()
+        if thread_id is None:
+            thread_id = self.robot.thread_ids.get("loop")
+        self.profiler = Profiler(thread_id, interval)
+        self.profiler.start()
+
+    def stop_profiler(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+
+    def report(self):
+        report = {name: histogram.summary() for name, histogram in self.histograms.items()}
+        for name, scheduler in self._schedulers.items():
+            report[name + "/scheduler"] = {"ticks": scheduler.ticks, "overruns": scheduler.overruns, "missed": scheduler.missed}
+        if self.profiler is not None:
+            report["profile"] = self.profiler.top()
+        return report
+
+    def publish(self):
+        put = self.robot.dashboard.put
+        for name, histogram in self.histograms.items():
+            put(f"timing/{name}/p50", histogram.percentile(50))
+            put(f"timing/{name}/p99", histogram.percentile(99))
+            put(f"timing/{name}/max", histogram.max)
+        for name, scheduler in self._schedulers.items():
+            put(f"timing/{name}/overruns", scheduler.overruns)
+            put(f"timing/{name}/missed", scheduler.missed)
+
+    def _send_report(self):
+        report = self.report()
+        profile = report.pop("profile", [])
+        self.robot.messenger.send({"id": "TimingReport", "timings": report,
+                                   "profile": [list(entry) for entry in profile]})
+
+
+if __name__ == "__main__":  # overhead of a timed callback
+    import timeit
+
+    histogram, calls = Histogram(), 200000
+
+    def callback():
+        pass
+
+    class Timer:
+        histograms = {}
+    timed = Instrumentation._timed(Timer(), "callback", callback)
+    plain = timeit.timeit(callback, number=calls) / calls
+    wrapped = timeit.timeit(timed, number=calls) / calls
+    print(f"plain: {plain * 1e6:.2f} us, timed: {wrapped * 1e6:.2f} us, overhead {(wrapped - plain) * 1e6:.2f} us/callback")
+    print(Timer.histograms["callback"].summary())
@@ -1,23 +1,40 @@
 from resources.Communications.Messenger import Messenger
+from resources.Communications.Dashboard import Dashboard
+from resources.Structure.Scheduler import Scheduler
+from resources.Structure.Instrumentation import Instrumentation
 import resources.configs
-from threading import Thread
+from threading import Thread, current_thread
 
 
 class Robot:
     """
     Python implementaion of an FRC robot.
     Listens for updates and calls relevent periodic functions
+    A simulated robot doesn't host or start any loop threads, the MatchSimulator ticks its schedulers instead
     """
     _auto = False
     _teleop = False
-    _running = True
-    _subsystems = []
-
-    def __init__(self):
-        self.messenger = Messenger()  # establish wifi connection
+    _running = False
+
+    def __init__(self, simulated=False):
+        self.simulated = simulated
+        self._subsystems = []
+        self._controllers = []
+        self._threads = []  # the scheduler threads of the current enable
+        self.thread_ids = {}  # "loop" / "subsystems": ident of the thread running that scheduler (ie for the profiler)
+        self.loop_scheduler = Scheduler(resources.configs.loop_period)
+        self.loop_scheduler.add(self._loop)
+        self.subsystem_scheduler = Scheduler(resources.configs.subsystem_period)
+        resources.configs.main_robot = self  # set before robot_init so subsystems can register themselves
+        self.messenger = Messenger(host=not simulated)  # establish wifi connection
+        self.dashboard = Dashboard(self.messenger)
+        if not simulated:
+            self.dashboard.start()
+        self.instrumentation = Instrumentation(self)  # callback timings, off unless configs.instrumentation
         self._setup_listeners()  # allow user to send commands
         self.robot_init()  # call overwrittable function
-        resources.configs.main_robot = self
+        if resources.configs.instrumentation:
+            self.instrumentation.enable()
 
     # setup listeners for when to trigger events
     def _setup_listeners(self):
@@ -26,28 +43,44 @@ class Robot:
         self.messenger.on_receive("auto", self._begin_auto)
         self.messenger.on_receive("teleop", self._begin_teleop)
 
-    # main loop threads
-    def _loops(self):
-        while self._running:
-            self.robot_periodic()
-            if self._auto: self.auto_periodic()
-            elif self._teleop: self.telop_periodic()
+    def add_subsystem(self, subsystem):
+        self._subsystems.append(subsystem)
+        self.subsystem_scheduler.add(subsystem.periodic, subsystem.rate_divisor)
+
+    def add_controller(self, controller):
+        self._controllers.append(controller)
 
-    def _subsystems(self):
-        while self._running:
-            for subsystem in self._subsystems:
-                subsystem.periodic()
+    # main loop, called every loop_period by the scheduler
+    def _loop(self):
+        for controller in self._controllers:  # button listeners run here, on the loop thread
+            controller.dispatch()
+        self.robot_periodic()
+        if self._auto: self.auto_periodic()
+        elif self._teleop: self.telop_periodic()
 
     # enable / disable robot
     def _begin(self):
+        if self._running: return
         self._running = True
         self.on_enable()
-        Thread(target=self._loops).start()
-        Thread(target=self._subsystems).start()
-
+        if self.simulated:
+            self.loop_scheduler.running = self.subsystem_scheduler.running = True
+            return
+        self._threads = [Thread(target=self.loop_scheduler.run, daemon=True),
+                         Thread(target=self.subsystem_scheduler.run, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        self.thread_ids = {"loop": self._threads[0].ident, "subsystems": self._threads[1].ident}
 
     def _stop(self):
         self._running = False
+        self.loop_scheduler.stop()
+        self.subsystem_scheduler.stop()
+        for thread in self._threads:  # so a quick re-enable can't run alongside the old threads
+            if thread is not current_thread():
+                thread.join()
+        self._threads = []
+        self.thread_ids = {}
         self.on_disable()
 
     # init and run loop for auto/teleop
@@ -59,7 +92,7 @@ class Robot:
     def _begin_teleop(self):
         self._auto = False
         self._teleop = True
-        self._begin_teleop()
+        self.teleop_init()
 
     # --- overwritten functions ---
     def robot_init(self):
@@ -0,0 +1,78 @@
+import time
+from resources import configs
+
+
+class Scheduler:
+    '''
+    Calls registered functions at a fixed period
+    Sleeps until an absolute deadline so timing doesn't drift, and each function can run every n ticks
+    Uses configs.clock, a simulator can also call tick itself instead of run
+    '''
+    def __init__(self, period, spin=None):
+        self.period = period
+        self.spin = configs.spin_time if spin is None else spin  # how long before the deadline to stop sleeping
+        self.running = False
+        self.ticks = 0
+        self.overruns = 0  # number of ticks that took longer than the period
+        self.missed = 0  # number of deadlines skipped because of overruns
+        self.last_duration = 0
+        self._tasks = []
+        self._generation = 0  # bumped by every run and stop, a run whose generation is stale exits
+
+    def add(self, func, divisor=1):
+        '''
+        Run func every `divisor` ticks (ie divisor=2 on a 10ms scheduler runs at 50hz)
+        '''
+        self._tasks.append((func, max(1, int(divisor))))
+
+    def remove(self, func):
+        self._tasks = [task for task in self._tasks if task[0] != func]
+
+    def replace(self, func, new):
+        '''
+        Run new in func's place, on the same divisor
+        '''
+        self._tasks = [(new if task == func else task, divisor) for task, divisor in self._tasks]
+
+    def tick(self):
+        ticks = self.ticks
+        for func, divisor in self._tasks:
+            if ticks % divisor == 0:
+                func()
+        self.ticks = ticks + 1
+
+    def run(self):
+        self._generation += 1
+        generation = self._generation
+        self.running = True
+        period = self.period
+        clock = configs.clock
+        deadline = clock()
+        while self.running and generation == self._generation:
+            start = clock()
+            self.tick()
+            now = clock()
+            self.last_duration = now - start
+
+            deadline += period
+            if now > deadline:  # overran, skip the missed deadlines but keep the same phase
+                skipped = int((now - deadline) / period) + 1
+                self.overruns += 1
+                self.missed += skipped
+                deadline += skipped * period
+            self._wait(deadline, clock)
+
+    def _wait(self, deadline, clock=time.perf_counter):
+        if hasattr(clock, "wait_until"):  # a virtual clock, wait for it to be advanced
+            while self.running and not clock.wait_until(deadline, 0.1):
+                pass
+            return
+        remaining = deadline - clock()
+        if remaining > self.spin:
+            time.sleep(remaining - self.spin)  # sleep through most of it so the cpu is idle
+        while clock() < deadline:  # spin the last bit since sleep can overshoot
+            pass
+
+    def stop(self):
+        self.running = False
+        self._generation += 1
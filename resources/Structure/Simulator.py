@@ -0,0 +1,127 @@
+import time
+from resources import configs
+from resources.Structure.Clock import VirtualClock
+
+'''
+Runs a robot through a match on a virtual clock, as fast as the cpu allows
+Nothing is hosted and no loop threads are started: the simulator jumps the clock to whatever happens next
+(a scheduler tick or a driver station message) and does it, motors from the "sim" backend follow the clock
+'''
+
+
+class DriverStation:
+    '''
+    A scripted driver station: (time, message) pairs delivered to the robot as if they came over the network
+    '''
+    def __init__(self, script=()):
+        self.script = sorted(script, key=lambda event: event[0])
+        self._next = 0
+
+    @classmethod
+    def match(cls, auto=15, teleop=135, script=()):
+        '''
+        Enable into auto, switch to teleop after auto seconds, disable at the end, plus any other (time, message)s
+        '''
+        return cls([(0, {"id": "enable"}), (0, {"id": "auto"}), (auto, {"id": "teleop"}),
+                    (auto + teleop, {"id": "disable"})] + list(script))
+
+    @property
+    def end(self):
+        return self.script[-1][0] if self.script else 0
+
+    def next_time(self):
+        return self.script[self._next][0] if self._next < len(self.script) else float('inf')
+
+    def due(self, time):
+        '''
+        The messages at or before time that haven't been sent yet
+        '''
+        start = self._next
+        while self._next < len(self.script) and self.script[self._next][0] <= time:
+            self._next += 1
+        return [message for _, message in self.script[start:self._next]]
+
+
+class MatchSimulator:
+    '''
+    Makes robot_class(simulated=True) on a VirtualClock with simulated motors and plays the driver station to it
+    Other schedulers (ie a Gyro's) can be ticked in step with add
+    '''
+    def __init__(self, robot_class, driver_station=None, motor_backend="sim"):
+        self.clock = VirtualClock()
+        self._previous_configs = configs.clock, configs.motor_backend, configs.main_robot
+        configs.clock = self.clock
+        configs.motor_backend = motor_backend
+        self.driver_station = DriverStation.match() if driver_station is None else driver_station
+        self.robot = robot_class(simulated=True)
+        self.robot.dashboard.scheduler.running = True
+        self._schedulers = []  # [scheduler, time of its next tick]
+        for scheduler in (self.robot.loop_scheduler, self.robot.subsystem_scheduler, self.robot.dashboard.scheduler):
+            self.add(scheduler, running=scheduler.running)
+        self.ticks = 0
+
+    def add(self, scheduler, running=True):
+        scheduler.running = running
+        self._schedulers.append([scheduler, None])
+
+    def run(self, duration=None):
+        '''
+        Simulate until duration seconds (the end of the driver station's script by default)
+        Returns how many times faster than real time it ran
+        '''
+        end = self.driver_station.end if duration is None else duration
+        clock, driver_station, schedulers = self.clock, self.driver_station, self._schedulers
+        dispatch = self.robot.messenger._dispatch
+        start = time.perf_counter()
+        simulated_start = clock.time
+        while True:
+            now = clock.time
+            for message in driver_station.due(now):
+                dispatch(message)
+            for entry in schedulers:
+                scheduler = entry[0]
+                if not scheduler.running:
+                    entry[1] = None
+                    continue
+                if entry[1] is None:  # just started, tick now and keep this phase
+                    entry[1] = now
+                if entry[1] <= now + 1e-9:
+                    scheduler.tick()
+                    self.ticks += 1
+                    entry[1] += scheduler.period
+            following = min([entry[1] for entry in schedulers if entry[1] is not None and entry[0].running] +
+                            [driver_station.next_time(), end])
+            if now >= end or following > end:
+                break
+            clock.set(following)
+        elapsed = time.perf_counter() - start
+        return (clock.time - simulated_start) / elapsed if elapsed > 0 else float('inf')
+
+    def close(self):
+        '''
+        Stop the robot's messenger and put configs back
+        '''
+        self.robot.messenger.close()
+        configs.clock, configs.motor_backend, configs.main_robot = self._previous_configs
+
+
+if __name__ == "__main__":  # a full match of a robot driving a simulated drivetrain
+    from resources.Structure.Robot import Robot
+    from resources.Interfaces.Motors import create_motor
+
+    class DemoRobot(Robot):
+        def robot_init(self):
+            self.left, self.right = create_motor(0), create_motor(1)
+
+        def auto_periodic(self):
+            self.left.speed, self.right.speed = 1.0, 1.2
+
+        def telop_periodic(self):
+            self.left.speed = self.right.speed = 0.5
+
+    simulator = MatchSimulator(DemoRobot)
+    speedup = simulator.run()
+    robot = simulator.robot
+    print(f"150s match: {simulator.ticks} scheduler ticks, {speedup:.0f}x real time, "
+          f"left drove {robot.left.position:.2f}, right {robot.right.position:.2f}")
+    simulator.close()
@@ -6,8 +6,10 @@ class Subsystem:
     A class that is called periodically by the main robot
     You should inherit this and then overwrite periodic
     '''
+    rate_divisor = 1  # run periodic every n subsystem ticks (configs.subsystem_period)
+
     def __init__(self):
-        configs.main_robot._substems.append(self)
+        configs.main_robot.add_subsystem(self)
 
     def periodic(self):
         pass
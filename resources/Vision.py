@@ -0,0 +1,36 @@
+from collections import deque
+from resources import configs
+from resources.Structure.Clock import now
+
+'''
+Vision pose measurements (ie from AprilTags on a coprocessor), fed into a PoseEstimator
+'''
+
+
+class Vision:
+    '''
+    Collects VisionPose messages (x, y, theta and either time, when the image was taken, or latency, how long ago it was)
+    Messages arrive on the messenger thread and are applied to the estimator on the loop thread
+    '''
+    def __init__(self, estimator, noise=None, max_queued=32):
+        self.estimator = estimator
+        self.noise = noise  # (x, y, theta) standard deviations, the estimator's vision_noise if None
+        self.measurements = deque(maxlen=max_queued)
+        self.applied = 0
+        robot = configs.main_robot
+        robot.messenger.on_receive("VisionPose", self._receive, pass_data=True)
+        robot.loop_scheduler.add(self.apply)
+
+    def _receive(self, msg):
+        time = msg["time"] if "time" in msg else now() - msg.get("latency", 0)
+        self.measurements.append((time, msg["x"], msg["y"], msg["theta"], msg.get("noise", self.noise)))
+
+    def apply(self):
+        '''
+        Give the estimator everything received since the last call, oldest first
+        '''
+        measurements, update = self.measurements, self.estimator.update_vision
+        while measurements:
+            time, x, y, theta, noise = measurements.popleft()
+            if update(time, x, y, theta, noise):
+                self.applied += 1
@@ -1,2 +1,10 @@
+import time
+
 main_robot = None   # a reference to the robot object
-loop_pause = 0  # not implemented yet
\ No newline at end of file
+loop_period = 0.02  # seconds between robot loop ticks (50hz)
+subsystem_period = 0.01  # seconds between subsystem ticks, subsystems can run slower with rate_divisor
+spin_time = 0.0005  # seconds before a deadline to stop sleeping and spin (keeps jitter under a ms)
+dashboard_period = 0.02  # seconds between dashboard publishes
+instrumentation = False  # time every robot and subsystem callback (see Structure/Instrumentation.py)
+clock = time.perf_counter  # where everything gets the time (see Structure/Clock.py), simulators swap in a VirtualClock
+motor_backend = "odrive"  # which Motors.backends create_motor uses, "sim" runs without hardware